@@ -12,6 +12,7 @@ Key GPT-5.2 Features Used:
 - Superior multimodal (vision) capabilities
 """
 
+import asyncio
 import os
 import base64
 import json
@@ -129,9 +130,16 @@ class DefectAnalysis:
     # GPT-5.2 reasoning metadata
     reasoning_tokens_used: int = 0
     model_version: str = "gpt-5.2"
+
+    # Memoized to_dict() output; results are not modified once built
+    _dict_cache: Optional[Dict[str, Any]] = field(
+        default=None, init=False, repr=False, compare=False
+    )
     
     def to_dict(self) -> Dict[str, Any]:
-        return {
+        if self._dict_cache is not None:
+            return self._dict_cache
+        self._dict_cache = {
             "defect_id": self.defect_id,
             "timestamp": self.timestamp.isoformat(),
             "facility": self.facility,
@@ -153,6 +161,7 @@ class DefectAnalysis:
             "reasoning_tokens_used": self.reasoning_tokens_used,
             "model_version": self.model_version,
         }
+        return self._dict_cache
 
 
 class WikoDefectAnalyzerGPT52:
@@ -391,6 +400,57 @@ class WikoDefectAnalyzerGPT52:
         Returns:
             DefectAnalysis with complete analysis and recommendations
         """
+        return await self._analyze_encoded(
+            self._encode_image(image_path),
+            self._get_image_media_type(image_path),
+            image_path,
+            product_sku,
+            facility,
+            production_data
+        )
+
+    async def analyze_defect_bytes(
+        self,
+        image_bytes: bytes,
+        product_sku: str,
+        facility: str = "yangjiang",
+        production_data: Optional[Dict[str, Any]] = None,
+        media_type: str = "image/jpeg",
+        image_url: Optional[str] = None
+    ) -> DefectAnalysis:
+        """
+        Same as analyze_defect, for an image already held in memory.
+        
+        Args:
+            image_bytes: Raw image content
+            product_sku: Product SKU being inspected
+            facility: Manufacturing facility
+            production_data: Optional batch/process data for correlation
+            media_type: MIME type of the image
+            image_url: Optional source location recorded on the result
+            
+        Returns:
+            DefectAnalysis with complete analysis and recommendations
+        """
+        return await self._analyze_encoded(
+            base64.b64encode(image_bytes).decode("utf-8"),
+            media_type,
+            image_url,
+            product_sku,
+            facility,
+            production_data
+        )
+
+    async def _analyze_encoded(
+        self,
+        image_base64: str,
+        media_type: str,
+        image_url: Optional[str],
+        product_sku: str,
+        facility: str,
+        production_data: Optional[Dict[str, Any]]
+    ) -> DefectAnalysis:
+        """Run the agent pipeline on a base64-encoded image"""
         import uuid
         
         defect_id = f"DEF-{datetime.now().strftime('%Y%m%d')}-{uuid.uuid4().hex[:8].upper()}"
@@ -399,7 +459,8 @@ class WikoDefectAnalyzerGPT52:
         # Step 1: Vision + Classification Agent (combined for efficiency)
         # GPT-5.2 handles multimodal + reasoning in single pass
         vision_classification = await self._run_vision_classification_agent(
-            image_path, 
+            image_base64,
+            media_type,
             product_sku,
             reasoning_effort="high"
         )
@@ -440,7 +501,7 @@ class WikoDefectAnalyzerGPT52:
             timestamp=datetime.now(),
             facility=facility,
             product_sku=product_sku,
-            image_url=image_path,
+            image_url=image_url,
             defect_detected=vision_classification.get("defect_detected", False),
             defect_type=DefectType(vision_classification.get("defect_type", "unknown").lower()),
             severity=Severity(vision_classification.get("severity", "cosmetic").lower()),
@@ -461,7 +522,8 @@ class WikoDefectAnalyzerGPT52:
     
     async def _run_vision_classification_agent(
         self,
-        image_path: str,
+        image_base64: str,
+        media_type: str,
         product_sku: str,
         reasoning_effort: str = "high"
     ) -> Dict[str, Any]:
@@ -473,9 +535,6 @@ class WikoDefectAnalyzerGPT52:
         - reasoning_effort='high' for accurate defect analysis
         - Structured JSON output with bounding boxes
         """
-        image_base64 = self._encode_image(image_path)
-        media_type = self._get_image_media_type(image_path)
-        
         system_prompt = f"""
         {self.WIKO_CONTEXT}
         
@@ -563,7 +622,9 @@ class WikoDefectAnalyzerGPT52:
                 # verbosity parameter may not be supported by all deployments
             )
 
-        response = self._call_azure_api_with_retry(make_api_call)
+        # The OpenAI client is synchronous; run it off the event loop so
+        # concurrent analyses (batch, multiple requests) actually overlap.
+        response = await asyncio.to_thread(self._call_azure_api_with_retry, make_api_call)
 
         # Extract content - GPT-5.2 may have different response structure
         content = response.choices[0].message.content
@@ -693,7 +754,7 @@ class WikoDefectAnalyzerGPT52:
                 # verbosity parameter may not be supported
             )
 
-        response = self._call_azure_api_with_retry(make_api_call)
+        response = await asyncio.to_thread(self._call_azure_api_with_retry, make_api_call)
         
         result = json.loads(response.choices[0].message.content)
         
@@ -780,7 +841,7 @@ class WikoDefectAnalyzerGPT52:
                 timeout=int(os.getenv('AZURE_API_TIMEOUT', 30))
             )
 
-        response = self._call_azure_api_with_retry(make_api_call)
+        response = await asyncio.to_thread(self._call_azure_api_with_retry, make_api_call)
         
         return json.loads(response.choices[0].message.content)
     
@@ -791,8 +852,6 @@ class WikoDefectAnalyzerGPT52:
         facility: str = "yangjiang"
     ) -> List[DefectAnalysis]:
         """Analyze multiple images in batch"""
-        import asyncio
-        
         tasks = [
             self.analyze_defect(path, product_sku, facility)
             for path in image_paths
@@ -885,7 +944,6 @@ async def analyze_single_image(image_path: str, sku: str = "WK-KN-200"):
 
 
 if __name__ == "__main__":
-    import asyncio
     import sys
     
     if len(sys.argv) > 1:
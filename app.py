@@ -7,6 +7,7 @@ Flask-based API for manufacturing defect analysis.
 import os
 import signal
 import sys
+import time
 from datetime import datetime
 from flask import Flask, jsonify, request
 from flask_cors import CORS
@@ -14,12 +15,19 @@ from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 
 from config import Config
-from views.analysis import analysis_bp, cleanup_event_loop
+from views.analysis import analysis_bp, shutdown_async_runner
 from views.ingest import ingest_bp
 from views.metadata import metadata_bp
 from utils.auth import require_api_key
+from utils.concurrency_limiter import get_redis_pool
+from utils.json_provider import OrjsonProvider
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
+# Flask 3 equivalents of JSON_SORT_KEYS / JSONIFY_PRETTYPRINT_REGULAR = False:
+# skip the per-response key sort and never indent
+app.json.sort_keys = False
+app.json.compact = True
 
 # Environment-based CORS configuration
 cors_origins = os.getenv('CORS_ORIGINS', 'http://localhost:3000,http://localhost:5173')
@@ -34,6 +42,10 @@ else:
     CORS(app, origins=allowed_origins, supports_credentials=True)
 
 # Configuration
+# Werkzeug checks a declared Content-Length against this before reading the
+# body (413 via too_large below). In production, also cap uploads at the
+# proxy (nginx client_max_body_size, see README) so oversized bodies never
+# reach a worker at all.
 app.config['MAX_CONTENT_LENGTH'] = Config.MAX_CONTENT_LENGTH
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'dev-secret-key-change-in-production')
 
@@ -42,29 +54,43 @@ app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'dev-secret-key-change-in-pro
 rate_limit_per_ip = os.getenv('RATE_LIMIT_PER_IP', '60 per minute')
 rate_limit_per_key = os.getenv('RATE_LIMIT_PER_KEY', '300 per minute')
 
+# Use Redis in production so limits are shared across workers. All limiter
+# checks reuse sockets from one pool instead of connecting per request.
+# The concurrency limiter shares the same pool.
+redis_url = os.getenv('REDIS_URL')
+limiter_storage_options = {}
+redis_pool = get_redis_pool()
+if redis_pool is not None:
+    limiter_storage_options['connection_pool'] = redis_pool
+
 limiter = Limiter(
     get_remote_address,
     app=app,
     default_limits=[rate_limit_per_ip],
-    storage_uri=os.getenv('REDIS_URL', 'memory://'),  # Use Redis in production
-    strategy="fixed-window"
+    storage_uri=redis_url or 'memory://',
+    storage_options=limiter_storage_options,
+    strategy="fixed-window"  # One INCR+EXPIRE per key; cheaper than moving-window
 )
 
+# Security headers, built once at startup
+SECURITY_HEADERS = {
+    'X-Content-Type-Options': 'nosniff',
+    'X-Frame-Options': 'DENY',
+    'X-XSS-Protection': '1; mode=block',
+    # Content Security Policy
+    'Content-Security-Policy': "default-src 'self'; img-src 'self' data:; style-src 'self' 'unsafe-inline'",
+}
+
+# Only add HSTS in production with HTTPS
+if os.getenv('ENVIRONMENT') == 'production':
+    SECURITY_HEADERS['Strict-Transport-Security'] = 'max-age=31536000; includeSubDomains'
+
+
 # Security headers middleware
 @app.after_request
 def add_security_headers(response):
     """Add security headers to all responses"""
-    response.headers['X-Content-Type-Options'] = 'nosniff'
-    response.headers['X-Frame-Options'] = 'DENY'
-    response.headers['X-XSS-Protection'] = '1; mode=block'
-
-    # Only add HSTS in production with HTTPS
-    if os.getenv('ENVIRONMENT') == 'production':
-        response.headers['Strict-Transport-Security'] = 'max-age=31536000; includeSubDomains'
-
-    # Content Security Policy
-    response.headers['Content-Security-Policy'] = "default-src 'self'; img-src 'self' data:; style-src 'self' 'unsafe-inline'"
-
+    response.headers.update(SECURITY_HEADERS)
     return response
 
 # Register Blueprints
@@ -97,6 +123,22 @@ def index():
     })
 
 
+# (epoch second, ISO string) for the health endpoint, which load balancers
+# poll frequently; the timestamp only needs one-second resolution
+_health_timestamp = (0, '')
+
+
+def _health_timestamp_iso() -> str:
+    """Return the current time as ISO 8601, rebuilt at most once per second"""
+    global _health_timestamp
+    second = int(time.time())
+    cached_second, cached_iso = _health_timestamp
+    if second != cached_second:
+        cached_iso = datetime.fromtimestamp(second).isoformat()
+        _health_timestamp = (second, cached_iso)
+    return cached_iso
+
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
@@ -104,7 +146,7 @@ def health_check():
         "status": "healthy",
         "service": "wiko-defect-analyzer",
         "version": "1.0.0",
-        "timestamp": datetime.now().isoformat()
+        "timestamp": _health_timestamp_iso()
     })
 
 
@@ -121,11 +163,16 @@ def server_error(e):
 def graceful_shutdown(signum, frame):
     """Handle graceful shutdown on SIGTERM/SIGINT"""
     print("\n\n🛑 Shutting down gracefully...")
-    cleanup_event_loop()
+    shutdown_async_runner()
     print("✅ Cleanup complete. Goodbye!")
     sys.exit(0)
 
 
+# Compile the URL map now (it is otherwise built lazily on the first request),
+# so with gunicorn preload_app the work happens once before forking
+app.url_map.update()
+
+
 # Register signal handlers for graceful shutdown
 signal.signal(signal.SIGTERM, graceful_shutdown)
 signal.signal(signal.SIGINT, graceful_shutdown)
@@ -0,0 +1,35 @@
+"""
+Gunicorn configuration for the Wiko Defect Analyzer API
+=======================================================
+Usage: gunicorn -c gunicorn_conf.py app:app
+"""
+
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5001')}"
+
+# Threaded workers: each analysis spends 10-30s waiting on the model API, so
+# a worker holds many in-flight requests on threads rather than one at a time.
+# Threads (not gevent) because the analyzer runs its own asyncio loops.
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+workers = int(os.getenv('GUNICORN_WORKERS', multiprocessing.cpu_count() * 2))
+threads = int(os.getenv('GUNICORN_THREADS', 16))
+
+# Import the app (and its API clients) once in the master, then fork
+preload_app = True
+
+# Model calls plus retries can exceed the 30s default
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 120))
+graceful_timeout = 30
+keepalive = 5
+
+# Reject oversized request lines/headers before they reach Flask. Body size
+# is capped by nginx (client_max_body_size, see README) and MAX_CONTENT_LENGTH.
+limit_request_line = 8190
+limit_request_fields = 100
+limit_request_field_size = 8190
+
+accesslog = '-'
+errorlog = '-'
+loglevel = os.getenv('LOG_LEVEL', 'info').lower()
@@ -1,51 +1,49 @@
 import json
 import boto3
 import base64
+import email.policy
 import os
+import re
+import time
 import uuid
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 from decimal import Decimal
+from email.parser import BytesParser
+from botocore.config import Config
 
-bedrock = boto3.client('bedrock-runtime', region_name=os.environ['AWS_REGION'])
-s3 = boto3.client('s3')
-dynamodb = boto3.resource('dynamodb')
-table = dynamodb.Table(os.environ['DEFECTS_TABLE'])
+# orjson is used when packaged with the function (layer); the stock Lambda
+# runtime only has the stdlib
+try:
+    import orjson
 
-def lambda_handler(event, context):
-    try:
-        # Parse request body
-        body = json.loads(event.get('body', '{}'))
-        image_base64 = body.get('image')
-        product_sku = body.get('product_sku', 'UNKNOWN')
-        facility = body.get('facility', 'UNKNOWN')
+    def _dumps(obj):
+        return orjson.dumps(obj).decode('utf-8')
 
-        if not image_base64:
-            return {
-                'statusCode': 400,
-                'headers': {
-                    'Access-Control-Allow-Origin': '*',
-                    'Access-Control-Allow-Headers': 'Content-Type',
-                    'Access-Control-Allow-Methods': 'POST, OPTIONS'
-                },
-                'body': json.dumps({'error': 'Missing image data'})
-            }
+    _loads = orjson.loads
+except ImportError:
+    _dumps = json.dumps
+    _loads = json.loads
 
-        # Generate IDs
-        defect_id = str(uuid.uuid4())
-        timestamp = int(datetime.utcnow().timestamp())
-        image_key = 'inspections/%s/%s/%s.jpg' % (facility, product_sku, defect_id)
+# Clients are created once per container and reused across warm invocations;
+# keep-alive and a larger pool avoid re-handshaking with Bedrock/S3 per call.
+_boto_config = Config(
+    max_pool_connections=50,
+    tcp_keepalive=True,
+    retries={'mode': 'adaptive', 'max_attempts': 3}
+)
 
-        # Store image in S3
-        image_data = base64.b64decode(image_base64.split(',')[1] if ',' in image_base64 else image_base64)
-        s3.put_object(
-            Bucket=os.environ['IMAGE_BUCKET'],
-            Key=image_key,
-            Body=image_data,
-            ContentType='image/jpeg'
-        )
+bedrock = boto3.client('bedrock-runtime', region_name=os.environ['AWS_REGION'], config=_boto_config)
+s3 = boto3.client('s3', config=_boto_config)
+dynamodb = boto3.resource('dynamodb', config=_boto_config)
+table = dynamodb.Table(os.environ['DEFECTS_TABLE'])
+
+# Background thread for the S3 upload so it overlaps the Bedrock call
+_io_pool = ThreadPoolExecutor(max_workers=2)
 
-        # Comprehensive prompt for structured JSON output
-        prompt = '''You are an expert quality inspector for Wiko Cutlery. Analyze this product image for manufacturing defects.
+# Comprehensive prompt for structured JSON output; built once per container,
+# only the SKU and facility are substituted per request
+_PROMPT_TEMPLATE = '''You are an expert quality inspector for Wiko Cutlery. Analyze this product image for manufacturing defects.
 
 CRITICAL: Output ONLY valid JSON with NO markdown, NO code blocks, NO explanatory text.
 
@@ -108,57 +106,156 @@ NO-DEFECT Example (use when product passes):
   "measurements": {"defect_size_mm": null, "affected_area_percent": null}
 }
 
-Analyze the image and output ONLY the JSON.''' % (product_sku, facility)
+Analyze the image and output ONLY the JSON.'''
+
+# Constant framing of the Bedrock request body. The base64 payload (JSON-safe
+# once validated) and the quoted prompt are spliced in as bytes, so the large
+# image string never goes through the JSON encoder.
+_ENVELOPE_PREFIX = (
+    b'{"anthropic_version":"bedrock-2023-05-31","max_tokens":4096,'
+    b'"messages":[{"role":"user","content":['
+    b'{"type":"image","source":{"type":"base64","media_type":"image/jpeg","data":"'
+)
+_ENVELOPE_MIDDLE = b'"}},{"type":"text","text":'
+_ENVELOPE_SUFFIX = b'}]}]}'
+
+# Outermost {...} in the model output; also skips any markdown code fences
+_JSON_OBJECT_RE = re.compile(r'\{.*\}', re.DOTALL)
+
+# Returned when the model output cannot be parsed (description is filled in)
+_FALLBACK_ANALYSIS = {
+    'has_defect': False,
+    'defect_type': 'none',
+    'severity': 'cosmetic',
+    'confidence': 0.5,
+    'location': {
+        'region': 'full_product',
+        'bounding_box': {'x': 0, 'y': 0, 'width': 100, 'height': 100}
+    },
+    'probable_stage': 'logo_print',
+    'root_cause_hypothesis': 'Response parsing error',
+    'corrective_actions': ['Manual review required'],
+    'recommended_action': 'escalate_to_supervisor',
+    'measurements': {'defect_size_mm': None, 'affected_area_percent': None}
+}
+
+def _to_decimal(value):
+    """Recursively convert floats to Decimal for DynamoDB"""
+    if isinstance(value, float):
+        return Decimal(str(value))
+    if isinstance(value, dict):
+        return {k: _to_decimal(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_to_decimal(v) for v in value]
+    return value
+
+
+def _parse_multipart(event, content_type):
+    """Parse a multipart/form-data body into {field name: bytes}"""
+    raw = event.get('body') or ''
+    # API Gateway delivers binary media types base64-encoded
+    raw = base64.b64decode(raw) if event.get('isBase64Encoded') else raw.encode('utf-8')
+    message = BytesParser(policy=email.policy.HTTP).parsebytes(
+        b'Content-Type: ' + content_type.encode('latin-1') + b'\r\n\r\n' + raw
+    )
+    fields = {}
+    for part in message.iter_parts():
+        name = part.get_param('name', header='content-disposition')
+        if name:
+            fields[name] = part.get_payload(decode=True)
+    return fields
+
+
+def lambda_handler(event, context):
+    try:
+        headers = {k.lower(): v for k, v in (event.get('headers') or {}).items()}
+        content_type = headers.get('content-type', '')
+
+        image_data = None
+        payload_b64 = None
+        if content_type.startswith('multipart/form-data'):
+            # Binary upload: image bytes arrive as-is, base64 only for Bedrock
+            fields = _parse_multipart(event, content_type)
+            image_data = fields.get('image')
+            product_sku = (fields.get('product_sku') or b'UNKNOWN').decode('utf-8')
+            facility = (fields.get('facility') or b'UNKNOWN').decode('utf-8')
+            if image_data:
+                payload_b64 = base64.b64encode(image_data).decode('ascii')
+        else:
+            # JSON body with a base64 (optionally data-URL) image
+            body = _loads(event.get('body') or '{}')
+            image_base64 = body.get('image')
+            product_sku = body.get('product_sku', 'UNKNOWN')
+            facility = body.get('facility', 'UNKNOWN')
+
+            if image_base64:
+                # Strip any data-URL prefix once; the same payload feeds S3 and Bedrock
+                comma = image_base64.find(',')
+                payload_b64 = image_base64[comma + 1:] if comma >= 0 else image_base64
+                try:
+                    # validate=True rejects non-alphabet characters, which keeps the
+                    # payload safe to embed verbatim in the Bedrock request body
+                    image_data = base64.b64decode(payload_b64, validate=True)
+                except ValueError:
+                    return {
+                        'statusCode': 400,
+                        'headers': {
+                            'Access-Control-Allow-Origin': '*',
+                            'Access-Control-Allow-Headers': 'Content-Type',
+                            'Access-Control-Allow-Methods': 'POST, OPTIONS'
+                        },
+                        'body': _dumps({'error': 'Invalid image data'})
+                    }
+
+        if not image_data:
+            return {
+                'statusCode': 400,
+                'headers': {
+                    'Access-Control-Allow-Origin': '*',
+                    'Access-Control-Allow-Headers': 'Content-Type',
+                    'Access-Control-Allow-Methods': 'POST, OPTIONS'
+                },
+                'body': _dumps({'error': 'Missing image data'})
+            }
+
+        # Generate IDs
+        defect_id = uuid.uuid4().hex
+        timestamp = int(time.time())
+        image_key = 'inspections/%s/%s/%s.jpg' % (facility, product_sku, defect_id)
+
+        # Store image in S3 while Bedrock runs; the model does not need the object
+        s3_upload = _io_pool.submit(
+            s3.put_object,
+            Bucket=os.environ['IMAGE_BUCKET'],
+            Key=image_key,
+            Body=image_data,
+            ContentType='image/jpeg'
+        )
+
+        prompt = _PROMPT_TEMPLATE % (product_sku, facility)
 
         # Call Bedrock
         response = bedrock.invoke_model(
             modelId=os.environ['BEDROCK_MODEL_ID'],
             contentType='application/json',
             accept='application/json',
-            body=json.dumps({
-                'anthropic_version': 'bedrock-2023-05-31',
-                'max_tokens': 4096,
-                'messages': [
-                    {
-                        'role': 'user',
-                        'content': [
-                            {
-                                'type': 'image',
-                                'source': {
-                                    'type': 'base64',
-                                    'media_type': 'image/jpeg',
-                                    'data': image_base64.split(',')[1] if ',' in image_base64 else image_base64
-                                }
-                            },
-                            {
-                                'type': 'text',
-                                'text': prompt
-                            }
-                        ]
-                    }
-                ]
-            })
+            body=b''.join([
+                _ENVELOPE_PREFIX,
+                payload_b64.encode('ascii'),
+                _ENVELOPE_MIDDLE,
+                json.dumps(prompt).encode('utf-8'),
+                _ENVELOPE_SUFFIX
+            ])
         )
 
         # Parse Bedrock response
-        response_body = json.loads(response['body'].read())
+        response_body = _loads(response['body'].read())
         content_text = response_body['content'][0]['text']
 
         # Extract JSON from response
         try:
-            # Remove markdown code blocks if present
-            if '```json' in content_text:
-                content_text = content_text.split('```json')[1].split('```')[0].strip()
-            elif '```' in content_text:
-                content_text = content_text.split('```')[1].split('```')[0].strip()
-
-            # Find JSON object
-            json_start = content_text.find('{')
-            json_end = content_text.rfind('}') + 1
-            if json_start >= 0 and json_end > json_start:
-                content_text = content_text[json_start:json_end]
-
-            analysis = json.loads(content_text)
+            match = _JSON_OBJECT_RE.search(content_text)
+            analysis = _loads(match.group(0) if match else content_text)
 
             # Validate required fields
             if 'has_defect' not in analysis:
@@ -167,23 +264,19 @@ Analyze the image and output ONLY the JSON.''' % (product_sku, facility)
         except Exception as e:
             print('Error parsing JSON: %s' % str(e))
             print('Raw content: %s' % content_text[:500])
-            # Fallback structure
-            analysis = {
-                'has_defect': False,
-                'defect_type': 'none',
-                'severity': 'cosmetic',
-                'confidence': 0.5,
-                'location': {
-                    'region': 'full_product',
-                    'bounding_box': {'x': 0, 'y': 0, 'width': 100, 'height': 100}
-                },
-                'description': 'Unable to parse AI response. Raw: %s' % content_text[:200],
-                'probable_stage': 'logo_print',
-                'root_cause_hypothesis': 'Response parsing error',
-                'corrective_actions': ['Manual review required'],
-                'recommended_action': 'escalate_to_supervisor',
-                'measurements': {'defect_size_mm': None, 'affected_area_percent': None}
-            }
+            # Fallback structure (never mutated, so a shallow copy is enough)
+            analysis = dict(
+                _FALLBACK_ANALYSIS,
+                description='Unable to parse AI response. Raw: %s' % content_text[:200]
+            )
+
+        # Wait for the S3 upload; a failed copy should not discard the analysis
+        try:
+            s3_upload.result()
+            image_persisted = True
+        except Exception as e:
+            print('Error storing image in S3: %s' % str(e))
+            image_persisted = False
 
         # Store in DynamoDB
         item = {
@@ -191,14 +284,16 @@ Analyze the image and output ONLY the JSON.''' % (product_sku, facility)
             'timestamp': timestamp,
             'facility': facility,
             'product_sku': product_sku,
-            'image_url': 's3://%s/%s' % (os.environ['IMAGE_BUCKET'], image_key),
+            'image_url': 's3://%s/%s' % (os.environ['IMAGE_BUCKET'], image_key) if image_persisted else None,
+            'image_persisted': image_persisted,
             'analysis': analysis,
-            'created_at': datetime.utcnow().isoformat()
+            'created_at': datetime.fromtimestamp(timestamp, tz=timezone.utc).isoformat()
         }
 
-        # Convert floats to Decimal for DynamoDB
-        item = json.loads(json.dumps(item), parse_float=Decimal)
-        table.put_item(Item=item)
+        # Convert floats to Decimal for DynamoDB. The write stays on the request
+        # path: Lambda freezes the environment once the handler returns, so a
+        # fire-and-forget put could be silently lost.
+        table.put_item(Item=_to_decimal(item))
 
         return {
             'statusCode': 200,
@@ -207,9 +302,10 @@ Analyze the image and output ONLY the JSON.''' % (product_sku, facility)
                 'Access-Control-Allow-Headers': 'Content-Type',
                 'Access-Control-Allow-Methods': 'POST, OPTIONS'
             },
-            'body': json.dumps({
+            'body': _dumps({
                 'defect_id': defect_id,
                 'timestamp': timestamp,
+                'image_persisted': image_persisted,
                 'analysis': analysis
             })
         }
@@ -223,5 +319,5 @@ Analyze the image and output ONLY the JSON.''' % (product_sku, facility)
                 'Access-Control-Allow-Headers': 'Content-Type',
                 'Access-Control-Allow-Methods': 'POST, OPTIONS'
             },
-            'body': json.dumps({'error': str(e)})
+            'body': _dumps({'error': str(e)})
         }
@@ -7,12 +7,15 @@ Tests the deployed AWS Bedrock backend
 import os
 import sys
 import json
-import base64
 import argparse
 import requests
 from datetime import datetime
+from functools import lru_cache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-# Load config
+# Load config (parsed once; repeated callers get the cached dict)
+@lru_cache(maxsize=1)
 def load_config():
     config = {}
     env_file = '.env.aws'
@@ -27,11 +30,16 @@ def load_config():
 CONFIG = load_config()
 API_ENDPOINT = CONFIG.get('AWS_API_ENDPOINT', '')
 
-
-def encode_image(image_path: str) -> str:
-    """Encode image to base64"""
-    with open(image_path, 'rb') as f:
-        return base64.b64encode(f.read()).decode('utf-8')
+# Shared session so consecutive tests reuse the TLS connection.
+# Retries apply to idempotent requests only (urllib3 skips POST by default).
+SESSION = requests.Session()
+_adapter = HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=50,
+    max_retries=Retry(total=2, backoff_factor=0.2, status_forcelist=[502, 503, 504])
+)
+SESSION.mount('https://', _adapter)
+SESSION.mount('http://', _adapter)
 
 
 def test_analyze(image_path: str, product_sku: str = 'WK-KN-200', facility: str = 'yangjiang'):
@@ -45,14 +53,11 @@ def test_analyze(image_path: str, product_sku: str = 'WK-KN-200', facility: str
         print(f"❌ Image not found: {image_path}")
         return None
     
-    # Encode image
-    image_b64 = encode_image(image_path)
-    print(f"→ Image encoded: {len(image_b64):,} bytes")
+    print(f"→ Image size: {os.path.getsize(image_path):,} bytes")
     
-    # Send request
+    # Send request as multipart: raw image bytes, no base64 inflation
     url = f"{API_ENDPOINT}/api/v1/analyze"
-    payload = {
-        'image': image_b64,
+    form = {
         'product_sku': product_sku,
         'facility': facility
     }
@@ -64,7 +69,13 @@ def test_analyze(image_path: str, product_sku: str = 'WK-KN-200', facility: str
     
     try:
         start_time = datetime.now()
-        response = requests.post(url, json=payload, timeout=120)
+        with open(image_path, 'rb') as image_file:
+            response = SESSION.post(
+                url,
+                files={'image': (os.path.basename(image_path), image_file, 'image/jpeg')},
+                data=form,
+                timeout=120
+            )
         elapsed = (datetime.now() - start_time).total_seconds()
         
         print(f"→ Response time: {elapsed:.1f}s")
@@ -125,7 +136,7 @@ def test_get_defects(facility: str = None, limit: int = 10):
     print(f"→ Fetching from: {url}")
     
     try:
-        response = requests.get(url, params=params, timeout=30)
+        response = SESSION.get(url, params=params, timeout=30)
         print(f"→ Status code: {response.status_code}")
         
         if response.status_code == 200:
@@ -167,7 +178,7 @@ def test_get_stats():
     print(f"→ Fetching from: {url}")
     
     try:
-        response = requests.get(url, timeout=30)
+        response = SESSION.get(url, timeout=30)
         print(f"→ Status code: {response.status_code}")
         
         if response.status_code == 200:
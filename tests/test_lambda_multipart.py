@@ -0,0 +1,98 @@
+"""
+Tests for the Lambda handler's multipart/form-data parsing.
+"""
+
+import base64
+import importlib.util
+from pathlib import Path
+
+import pytest
+
+BOUNDARY = "wikoBoundary7MA4YWxk"
+CONTENT_TYPE = f"multipart/form-data; boundary={BOUNDARY}"
+
+# JPEG header plus bytes that are not valid UTF-8, a CRLF and a
+# boundary-like sequence, all of which must survive parsing unchanged
+IMAGE_BYTES = b"\xff\xd8\xff\xe0\x00\x10JFIF\x00\x80\x81\xfe\r\n--wiko\r\n\x00\xff\xd9"
+
+
+@pytest.fixture(scope="module")
+def analyze_function():
+    # `lambda` is a keyword, so the module is loaded from its path. Clients
+    # are created at import but make no network calls until used.
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setenv("AWS_REGION", "us-east-1")
+        mp.setenv("AWS_DEFAULT_REGION", "us-east-1")
+        mp.setenv("DEFECTS_TABLE", "defects-test")
+        path = Path(__file__).resolve().parent.parent / "lambda" / "analyze_function.py"
+        spec = importlib.util.spec_from_file_location("analyze_function", path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        yield module
+
+
+def _multipart_body(image=IMAGE_BYTES):
+    return b"".join([
+        f"--{BOUNDARY}\r\n".encode(),
+        b'Content-Disposition: form-data; name="image"; filename="knife.jpg"\r\n',
+        b"Content-Type: image/jpeg\r\n\r\n",
+        image,
+        f"\r\n--{BOUNDARY}\r\n".encode(),
+        b'Content-Disposition: form-data; name="product_sku"\r\n\r\n',
+        b"WK-KN-200",
+        f"\r\n--{BOUNDARY}\r\n".encode(),
+        b'Content-Disposition: form-data; name="facility"\r\n\r\n',
+        b"yangjiang",
+        f"\r\n--{BOUNDARY}--\r\n".encode(),
+    ])
+
+
+def test_binary_part_is_returned_byte_for_byte(analyze_function):
+    event = {
+        "body": base64.b64encode(_multipart_body()).decode("ascii"),
+        "isBase64Encoded": True,
+    }
+
+    fields = analyze_function._parse_multipart(event, CONTENT_TYPE)
+
+    assert fields == {
+        "image": IMAGE_BYTES,
+        "product_sku": b"WK-KN-200",
+        "facility": b"yangjiang",
+    }
+
+
+def test_text_body_without_base64_flag(analyze_function):
+    body = _multipart_body(image=b"plain-text-part").decode("utf-8")
+    event = {"body": body, "isBase64Encoded": False}
+
+    fields = analyze_function._parse_multipart(event, CONTENT_TYPE)
+
+    assert fields["image"] == b"plain-text-part"
+    assert fields["product_sku"] == b"WK-KN-200"
+
+
+def test_missing_boundary_yields_no_fields(analyze_function):
+    event = {
+        "body": base64.b64encode(_multipart_body()).decode("ascii"),
+        "isBase64Encoded": True,
+    }
+
+    assert analyze_function._parse_multipart(event, "multipart/form-data") == {}
+
+
+def test_missing_boundary_is_rejected_by_handler(analyze_function):
+    event = {
+        "headers": {"Content-Type": "multipart/form-data"},
+        "body": base64.b64encode(_multipart_body()).decode("ascii"),
+        "isBase64Encoded": True,
+    }
+
+    response = analyze_function.lambda_handler(event, None)
+
+    assert response["statusCode"] == 400
+    assert "Missing image data" in response["body"]
+
+
+def test_empty_body_yields_no_fields(analyze_function):
+    assert analyze_function._parse_multipart({"body": None}, CONTENT_TYPE) == {}
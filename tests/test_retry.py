@@ -0,0 +1,254 @@
+"""
+Tests for utils.retry
+"""
+
+import asyncio
+from email.utils import formatdate
+
+import pytest
+
+from utils import retry
+from utils.retry import CircuitBreaker
+
+
+class FakeClock:
+    """Stands in for the time module inside utils.retry"""
+
+    def __init__(self, now=1_000_000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(retry, "time", fake)
+    return fake
+
+
+class ServiceDown(Exception):
+    pass
+
+
+def _fail():
+    raise ServiceDown("down")
+
+
+def _trip(breaker):
+    for _ in range(breaker.failure_threshold):
+        with pytest.raises(ServiceDown):
+            breaker.call(_fail)
+
+
+def test_circuit_opens_at_failure_threshold(clock):
+    breaker = CircuitBreaker(failure_threshold=3, recovery_timeout=30, expected_exception=ServiceDown)
+
+    for _ in range(2):
+        with pytest.raises(ServiceDown):
+            breaker.call(_fail)
+        assert breaker.state == "CLOSED"
+
+    with pytest.raises(ServiceDown):
+        breaker.call(_fail)
+    assert breaker.state == "OPEN"
+
+
+def test_open_circuit_fails_fast_until_recovery_timeout(clock):
+    breaker = CircuitBreaker(failure_threshold=2, recovery_timeout=30, expected_exception=ServiceDown)
+    _trip(breaker)
+    calls = []
+
+    clock.advance(29)
+    with pytest.raises(Exception, match="Circuit breaker is OPEN"):
+        breaker.call(calls.append, "attempt")
+    assert calls == []
+    assert breaker.state == "OPEN"
+
+
+def test_successful_probe_closes_circuit(clock):
+    breaker = CircuitBreaker(failure_threshold=2, recovery_timeout=30, expected_exception=ServiceDown)
+    _trip(breaker)
+
+    clock.advance(30)
+    assert breaker.call(lambda: "ok") == "ok"
+    assert breaker.state == "CLOSED"
+    assert breaker.failure_count == 0
+
+
+def test_failed_probe_reopens_circuit(clock):
+    breaker = CircuitBreaker(failure_threshold=2, recovery_timeout=30, expected_exception=ServiceDown)
+    _trip(breaker)
+
+    clock.advance(30)
+    with pytest.raises(ServiceDown):
+        breaker.call(_fail)
+    assert breaker.state == "OPEN"
+    assert breaker.last_failure_time == clock.now
+
+    # The recovery timeout restarts from the failed probe
+    clock.advance(29)
+    with pytest.raises(Exception, match="Circuit breaker is OPEN"):
+        breaker.call(lambda: "ok")
+
+
+def test_half_open_admits_a_single_probe(clock):
+    breaker = CircuitBreaker(failure_threshold=2, recovery_timeout=30, expected_exception=ServiceDown)
+    _trip(breaker)
+    clock.advance(30)
+
+    def probe():
+        # A second caller arriving while the probe is in flight is rejected
+        assert breaker.state == "HALF_OPEN"
+        with pytest.raises(Exception, match="Recovery probe in progress"):
+            breaker.call(lambda: "second")
+        return "probe"
+
+    assert breaker.call(probe) == "probe"
+    assert breaker.state == "CLOSED"
+
+
+def test_unexpected_error_releases_probe_and_stays_half_open(clock):
+    breaker = CircuitBreaker(failure_threshold=2, recovery_timeout=30, expected_exception=ServiceDown)
+    _trip(breaker)
+    clock.advance(30)
+
+    def bad_request():
+        raise KeyError("not a service failure")
+
+    with pytest.raises(KeyError):
+        breaker.call(bad_request)
+    assert breaker.state == "HALF_OPEN"
+
+    # The probe slot was freed, so the next call becomes the probe
+    assert breaker.call(lambda: "ok") == "ok"
+    assert breaker.state == "CLOSED"
+
+
+def test_async_probe_closes_circuit(clock):
+    breaker = CircuitBreaker(failure_threshold=2, recovery_timeout=30, expected_exception=ServiceDown)
+    _trip(breaker)
+    clock.advance(30)
+
+    async def ok():
+        return "ok"
+
+    assert asyncio.run(breaker.call_async(ok)) == "ok"
+    assert breaker.state == "CLOSED"
+
+
+def _http_date(timestamp):
+    return formatdate(timestamp, usegmt=True)
+
+
+@pytest.mark.parametrize("value, expected", [
+    (None, None),
+    (30, 30.0),
+    (1.5, 1.5),
+    ("120", 120.0),
+    (" 7 ", 7.0),
+    ("-5", 0.0),
+    ("", None),
+    ("soon", None),
+    ("Wed, 99 Foo 2024 99:99:99 GMT", None),
+    (object(), None),
+])
+def test_parse_retry_after(clock, value, expected):
+    assert retry._parse_retry_after(value) == expected
+
+
+@pytest.mark.parametrize("offset, expected", [
+    (45, 45.0),
+    (0, 0.0),
+    (-60, 0.0),  # Dates in the past mean "retry now"
+])
+def test_parse_retry_after_http_date(clock, offset, expected):
+    assert retry._parse_retry_after(_http_date(clock.now + offset)) == pytest.approx(expected)
+
+
+class RateLimited(Exception):
+    status_code = 429
+
+    def __init__(self, retry_after=None, headers=None):
+        super().__init__("rate limited")
+        if retry_after is not None:
+            self.retry_after = retry_after
+        if headers is not None:
+            self.response = type("Response", (), {"headers": headers})()
+
+
+@pytest.mark.parametrize("exc, expected", [
+    (RateLimited(retry_after=12), 12.0),
+    (RateLimited(headers={"Retry-After": "20"}), 20.0),
+    (RateLimited(headers={"RateLimit-Reset": "8"}), 8.0),
+    # Retry-After wins over RateLimit-Reset
+    (RateLimited(headers={"Retry-After": "3", "RateLimit-Reset": "8"}), 3.0),
+    # An unparseable value falls through to the next source
+    (RateLimited(retry_after="later", headers={"Retry-After": "5"}), 5.0),
+    (RateLimited(headers={"Retry-After": "later", "RateLimit-Reset": "9"}), 9.0),
+    (RateLimited(headers={"Retry-After": "later"}), None),
+    (RateLimited(headers={}), None),
+    (RateLimited(), None),
+])
+def test_rate_limit_delay(clock, exc, expected):
+    assert retry._rate_limit_delay(exc) == expected
+
+
+def test_rate_limit_delay_http_date(clock):
+    exc = RateLimited(headers={"Retry-After": _http_date(clock.now + 90)})
+    assert retry._rate_limit_delay(exc) == pytest.approx(90.0)
+
+
+def _failing_after(clock, seconds_per_call):
+    calls = []
+
+    def flaky():
+        calls.append(clock.now)
+        clock.advance(seconds_per_call)
+        raise ServiceDown("down")
+
+    return flaky, calls
+
+
+def test_deadline_gives_up_without_logging_a_retry(clock, caplog):
+    flaky, calls = _failing_after(clock, 1)
+    wrapped = retry.retry_with_backoff(
+        max_retries=3, initial_delay=10, jitter=False, total_timeout=5
+    )(flaky)
+
+    with caplog.at_level("WARNING", logger="utils.retry"):
+        with pytest.raises(ServiceDown):
+            wrapped()
+
+    assert len(calls) == 1
+    messages = [r.getMessage() for r in caplog.records]
+    assert not any("Retrying" in m for m in messages)
+    assert any("Giving up" in m for m in messages)
+
+
+def test_retry_is_logged_only_when_scheduled(clock, caplog):
+    flaky, calls = _failing_after(clock, 1)
+    # Attempt 1 fails at t=1 and waits 1s; attempt 2 fails at t=3, when a 2s
+    # wait would reach the 4s budget, so it gives up
+    wrapped = retry.retry_with_backoff(
+        max_retries=3, initial_delay=1, jitter=False, total_timeout=4
+    )(flaky)
+
+    with caplog.at_level("WARNING", logger="utils.retry"):
+        with pytest.raises(ServiceDown):
+            wrapped()
+
+    assert len(calls) == 2
+    messages = [r.getMessage() for r in caplog.records]
+    assert sum("Retrying" in m for m in messages) == 1
+    assert any("Giving up" in m for m in messages)
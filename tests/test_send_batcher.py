@@ -0,0 +1,140 @@
+"""
+Tests for the /ingest Service Bus send batcher, using a fake sender.
+"""
+
+import pytest
+from azure.servicebus.exceptions import MessageSizeExceededError
+
+from views import ingest
+
+OVERSIZED = "oversized"
+
+
+class FakeBatch:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.messages = []
+
+    def add_message(self, message):
+        if message == OVERSIZED or len(self.messages) >= self.capacity:
+            raise MessageSizeExceededError(message="batch is full")
+        self.messages.append(message)
+
+
+class FakeSender:
+    def __init__(self, capacity=100, error=None):
+        self.capacity = capacity
+        self.error = error
+        self.sent = []
+
+    def create_message_batch(self):
+        return FakeBatch(self.capacity)
+
+    def send_messages(self, batch):
+        if self.error:
+            raise self.error
+        self.sent.append(list(batch.messages))
+
+
+@pytest.fixture
+def sender(monkeypatch):
+    fake = FakeSender()
+    monkeypatch.setattr(ingest, "_get_sender", lambda queue_name: fake)
+    return fake
+
+
+@pytest.fixture
+def make_batcher():
+    batchers = []
+
+    def _make(max_messages=50, interval=0.2):
+        batcher = ingest._SendBatcher("test-queue", max_messages, interval)
+        batchers.append(batcher)
+        return batcher
+
+    yield _make
+    for batcher in batchers:
+        batcher.close()
+
+
+def test_submits_within_interval_share_one_batch(sender, make_batcher):
+    batcher = make_batcher()
+    futures = [batcher.submit(m) for m in ("a", "b", "c")]
+
+    for future in futures:
+        assert future.result(timeout=5) is None
+    assert sender.sent == [["a", "b", "c"]]
+
+
+def test_batch_is_flushed_at_max_messages(sender, make_batcher):
+    batcher = make_batcher(max_messages=2)
+    futures = [batcher.submit(m) for m in ("a", "b", "c")]
+
+    for future in futures:
+        future.result(timeout=5)
+    assert sender.sent == [["a", "b"], ["c"]]
+
+
+def test_full_batch_is_split(sender, make_batcher):
+    sender.capacity = 2
+    batcher = make_batcher()
+    futures = [batcher.submit(m) for m in ("a", "b", "c")]
+
+    for future in futures:
+        assert future.result(timeout=5) is None
+    assert sender.sent == [["a", "b"], ["c"]]
+
+
+def test_oversized_message_fails_alone(sender, make_batcher):
+    batcher = make_batcher()
+    before = batcher.submit("a")
+    oversized = batcher.submit(OVERSIZED)
+    after = batcher.submit("b")
+
+    with pytest.raises(MessageSizeExceededError):
+        oversized.result(timeout=5)
+    assert before.result(timeout=5) is None
+    assert after.result(timeout=5) is None
+    assert sender.sent == [["a"], ["b"]]
+
+
+def test_send_error_reaches_every_waiting_future(sender, make_batcher):
+    sender.error = RuntimeError("link detached")
+    batcher = make_batcher()
+    futures = [batcher.submit(m) for m in ("a", "b", "c")]
+
+    for future in futures:
+        with pytest.raises(RuntimeError, match="link detached"):
+            future.result(timeout=5)
+
+
+def test_sender_error_reaches_every_waiting_future(monkeypatch, make_batcher):
+    def _no_sender(queue_name):
+        raise ValueError("AZURE_SERVICEBUS_NAMESPACE is required")
+
+    monkeypatch.setattr(ingest, "_get_sender", _no_sender)
+    batcher = make_batcher()
+    futures = [batcher.submit(m) for m in ("a", "b")]
+
+    for future in futures:
+        with pytest.raises(ValueError):
+            future.result(timeout=5)
+
+
+def test_close_flushes_pending_and_stops_thread(sender, make_batcher):
+    # A long interval: only close() can end the collection window early
+    batcher = make_batcher(interval=60)
+    futures = [batcher.submit(m) for m in ("a", "b")]
+    thread = batcher._thread
+
+    batcher.close()
+
+    assert not thread.is_alive()
+    assert all(f.done() for f in futures)
+    assert sender.sent == [["a", "b"]]
+
+
+def test_close_without_submit_is_a_noop(make_batcher):
+    batcher = make_batcher()
+    batcher.close()
+    assert batcher._thread is None
@@ -2,24 +2,43 @@
 Authentication utilities for Wiko Defect Analyzer API
 """
 
+import hmac
 import os
 from functools import wraps
+from typing import Optional
 from flask import request, jsonify
 
+# Read once at import; changing these requires a restart (or reload_auth_config)
+API_KEY: Optional[str] = None
+AUTH_DISABLED = False
+_api_key_bytes = b''
+
+
+def reload_auth_config() -> None:
+    """Re-read API_KEY and ENVIRONMENT from the environment (used by tests)"""
+    global API_KEY, AUTH_DISABLED, _api_key_bytes
+    API_KEY = os.getenv('API_KEY')
+    # Skip authentication in development mode if API_KEY not set
+    AUTH_DISABLED = not API_KEY and os.getenv('ENVIRONMENT', 'development') == 'development'
+    _api_key_bytes = API_KEY.encode('utf-8') if API_KEY else b''
+
+
+reload_auth_config()
+
 
 def require_api_key(f):
     """Decorator to require API key authentication for endpoints"""
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        # Skip authentication in development mode if API_KEY not set
-        api_key_required = os.getenv('API_KEY')
-        if not api_key_required and os.getenv('ENVIRONMENT', 'development') == 'development':
+        if AUTH_DISABLED:
             # Development mode without API key - allow access but warn
             return f(*args, **kwargs)
 
-        # Production mode or API key is set - enforce authentication
+        # Production mode or API key is set - enforce authentication.
+        # compare_digest keeps the comparison constant-time.
         api_key = request.headers.get('X-API-Key') or request.args.get('api_key')
-        if not api_key or api_key != api_key_required:
+        if (not api_key or not _api_key_bytes
+                or not hmac.compare_digest(api_key.encode('utf-8'), _api_key_bytes)):
             return jsonify({
                 "error": "Unauthorized",
                 "message": "Valid API key required. Include X-API-Key header or api_key query parameter."
@@ -0,0 +1,46 @@
+"""
+Shared Azure credentials for the ingest API and the defect worker.
+
+DefaultAzureCredential caches tokens and its probed credential chain per
+instance, so each process builds one and hands it to every client.
+"""
+
+import threading
+from typing import Optional
+
+from azure.identity import DefaultAzureCredential
+
+_credential: Optional[DefaultAzureCredential] = None
+_async_credential = None
+_credential_lock = threading.Lock()
+
+
+def get_credential() -> DefaultAzureCredential:
+    """Process-wide sync credential for BlobServiceClient / ServiceBusClient"""
+    global _credential
+    if _credential is None:
+        with _credential_lock:
+            if _credential is None:
+                _credential = DefaultAzureCredential()
+    return _credential
+
+
+def get_async_credential():
+    """Process-wide credential for the azure.*.aio clients"""
+    global _async_credential
+    if _async_credential is None:
+        # Imported here so the sync API does not load the async stack
+        from azure.identity.aio import DefaultAzureCredential as AsyncDefaultAzureCredential
+
+        with _credential_lock:
+            if _async_credential is None:
+                _async_credential = AsyncDefaultAzureCredential()
+    return _async_credential
+
+
+async def close_async_credential() -> None:
+    """Close the async credential's HTTP sessions, if one was created"""
+    global _async_credential
+    if _async_credential is not None:
+        await _async_credential.close()
+        _async_credential = None
@@ -0,0 +1,164 @@
+"""
+Concurrent-request limiting backed by Redis sorted sets.
+
+Bounds the number of in-flight model calls across all workers, which the
+frequency-based rate limiter cannot do for 10-30s analyses.
+"""
+
+import os
+import time
+import uuid
+import logging
+import threading
+from functools import wraps
+from typing import Callable, Optional
+import redis
+from flask import jsonify
+
+logger = logging.getLogger(__name__)
+
+# Drops expired entries (holders that crashed without releasing), then admits
+# the request only if all of its slots fit under the limit. Members are scored
+# by expiry time so holders with different TTLs can share one set.
+# KEYS[1]=set key, ARGV: now, request id, limit, ttl seconds, slots
+_ACQUIRE_SCRIPT = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+local slots = tonumber(ARGV[5])
+if redis.call('ZCARD', KEYS[1]) + slots > tonumber(ARGV[3]) then
+    return 0
+end
+local expires = tonumber(ARGV[1]) + tonumber(ARGV[4])
+for i = 1, slots do
+    redis.call('ZADD', KEYS[1], expires, ARGV[2] .. ':' .. i)
+end
+if redis.call('TTL', KEYS[1]) < tonumber(ARGV[4]) then
+    redis.call('EXPIRE', KEYS[1], ARGV[4])
+end
+return 1
+"""
+
+
+class ConcurrencyLimiter:
+    """
+    Distributed semaphore using a Redis sorted set.
+
+    Each slot held by an in-flight request is a member scored by its expiry
+    time: ZADD on enter, ZREM on exit, ZCARD to check capacity. A request
+    that makes several model calls at once holds one slot per call.
+    """
+
+    def __init__(
+        self,
+        client: redis.Redis,
+        key: str = "wiko:inflight:analyze",
+        max_concurrent: int = 10,
+        slot_ttl: int = 120
+    ):
+        self.client = client
+        self.key = key
+        self.max_concurrent = max_concurrent
+        self.slot_ttl = slot_ttl
+        self._acquire_script = client.register_script(_ACQUIRE_SCRIPT)
+
+    def acquire(self, slots: int = 1, ttl: Optional[int] = None) -> Optional[str]:
+        """
+        Reserve slots, all or none. ttl defaults to slot_ttl and should cover
+        the request's worst-case duration.
+
+        Returns a request id to release, or None if full.
+        """
+        request_id = uuid.uuid4().hex
+        acquired = self._acquire_script(
+            keys=[self.key],
+            args=[time.time(), request_id, self.max_concurrent, ttl or self.slot_ttl, slots]
+        )
+        return request_id if acquired else None
+
+    def release(self, request_id: str, slots: int = 1) -> None:
+        """Release slots previously acquired under request_id"""
+        self.client.zrem(self.key, *[f"{request_id}:{i}" for i in range(1, slots + 1)])
+
+
+_pool: Optional[redis.ConnectionPool] = None
+_limiter: Optional[ConcurrencyLimiter] = None
+_limiter_lock = threading.Lock()
+
+
+def get_redis_pool() -> Optional[redis.ConnectionPool]:
+    """Process-wide Redis connection pool from REDIS_URL, or None when Redis is not configured"""
+    global _pool
+    redis_url = os.getenv('REDIS_URL')
+    if not redis_url:
+        return None
+
+    if _pool is None:
+        with _limiter_lock:
+            if _pool is None:
+                _pool = redis.ConnectionPool.from_url(
+                    redis_url,
+                    max_connections=int(os.getenv('REDIS_MAX_CONNECTIONS', 100))
+                )
+    return _pool
+
+
+def get_concurrency_limiter() -> Optional[ConcurrencyLimiter]:
+    """Build the shared limiter on the shared Redis pool, or None when Redis is not configured"""
+    global _limiter
+    pool = get_redis_pool()
+    if pool is None:
+        return None
+
+    if _limiter is None:
+        with _limiter_lock:
+            if _limiter is None:
+                _limiter = ConcurrencyLimiter(
+                    redis.Redis(connection_pool=pool),
+                    max_concurrent=int(os.getenv('MAX_CONCURRENT_ANALYSES', 10)),
+                    slot_ttl=int(os.getenv('CONCURRENCY_SLOT_TTL', 120))
+                )
+    return _limiter
+
+
+def limit_concurrency(f=None, *, slots: Optional[Callable[[], int]] = None, ttl_multiplier: int = 1):
+    """
+    Decorator rejecting requests with 429 when too many analyses are in flight.
+
+    Use bare for one model call per request. For requests that fan out,
+    slots returns the number of concurrent model calls (read from the
+    request) and ttl_multiplier scales the slot TTL to the request's
+    worst-case duration.
+    """
+    def decorator(view):
+        @wraps(view)
+        def decorated_function(*args, **kwargs):
+            limiter = get_concurrency_limiter()
+            if limiter is None:
+                return view(*args, **kwargs)
+
+            # Never ask for more than the limit, or the request could not run at all
+            needed = max(1, min(slots() if slots else 1, limiter.max_concurrent))
+            try:
+                request_id = limiter.acquire(needed, limiter.slot_ttl * ttl_multiplier)
+            except redis.RedisError as e:
+                # Fail open: the per-IP rate limiter still applies
+                logger.warning(f"Concurrency limiter unavailable: {e}")
+                return view(*args, **kwargs)
+
+            if request_id is None:
+                return jsonify({
+                    "error": "Too many concurrent analyses",
+                    "message": "Analysis capacity is currently saturated. Please retry shortly."
+                }), 429
+
+            try:
+                return view(*args, **kwargs)
+            finally:
+                try:
+                    limiter.release(request_id, needed)
+                except redis.RedisError as e:
+                    logger.warning(f"Failed to release concurrency slot {request_id}: {e}")
+        return decorated_function
+
+    if f is not None:
+        return decorator(f)
+    return decorator
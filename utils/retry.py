@@ -3,9 +3,12 @@ Retry logic utilities for resilient Azure API calls
 """
 
 import time
+import random
 import logging
+import threading
 from typing import Callable, Any, TypeVar, Optional
 from functools import wraps
+from email.utils import parsedate_to_datetime
 import asyncio
 
 logger = logging.getLogger(__name__)
@@ -13,12 +16,134 @@ logger = logging.getLogger(__name__)
 T = TypeVar('T')
 
 
+def _backoff_delay(
+    attempt: int,
+    initial_delay: float,
+    exponential_base: float,
+    max_delay: float,
+    jitter: bool
+) -> float:
+    """
+    Exponential backoff for the given attempt, optionally with "Full Jitter".
+
+    Full Jitter sleeps a uniform random time in [0, capped backoff], so
+    clients failing together do not retry in lockstep.
+    """
+    capped = min(initial_delay * (exponential_base ** attempt), max_delay)
+    return random.uniform(0, capped) if jitter else capped
+
+
+def _parse_retry_after(value: Any) -> Optional[float]:
+    """
+    Parse a Retry-After style value into seconds to wait.
+
+    Accepts delta-seconds (number or numeric string) or an HTTP-date
+    (RFC 7231). Returns None if the value is missing or unparseable.
+    """
+    if value is None:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        pass
+
+    try:
+        retry_at = parsedate_to_datetime(str(value))
+    except (TypeError, ValueError):
+        return None
+    if retry_at is None:
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+def _rate_limit_delay(exc: Exception) -> Optional[float]:
+    """
+    Seconds the server asked us to wait, from a 429 exception.
+
+    Checks an explicit ``retry_after`` attribute, then the ``Retry-After``
+    and ``RateLimit-Reset`` headers on ``exc.response`` if present.
+    """
+    delay = _parse_retry_after(getattr(exc, 'retry_after', None))
+    if delay is not None:
+        return delay
+
+    headers = getattr(getattr(exc, 'response', None), 'headers', None)
+    if headers:
+        for header in ('Retry-After', 'RateLimit-Reset'):
+            delay = _parse_retry_after(headers.get(header))
+            if delay is not None:
+                return delay
+    return None
+
+
+def _plan_next_delay(
+    exc: Exception,
+    attempt: int,
+    initial_delay: float,
+    exponential_base: float,
+    max_delay: float,
+    jitter: bool
+) -> float:
+    """
+    Seconds to wait before retrying after ``exc`` failed the given attempt.
+
+    Rate limits (HTTP 429) honor the server's Retry-After when given, capped
+    at max_delay with up to 10% jitter; everything else uses backoff.
+    """
+    if getattr(exc, 'status_code', None) == 429:
+        retry_after = _rate_limit_delay(exc)
+        if retry_after is not None:
+            delay = min(retry_after, max_delay)
+            if jitter:
+                delay += random.uniform(0, delay * 0.1)
+            return delay
+    return _backoff_delay(attempt, initial_delay, exponential_base, max_delay, jitter)
+
+
+def _log_retry(exc: Exception, attempt: int, max_retries: int, delay: float) -> None:
+    """Log a retry that has been scheduled"""
+    if getattr(exc, 'status_code', None) == 429:
+        logger.warning(
+            "Rate limit hit on attempt %d/%d. Retrying after %.1fs...",
+            attempt + 1, max_retries + 1, delay
+        )
+    else:
+        logger.warning(
+            "Attempt %d/%d failed: %s. Retrying in %.1fs...",
+            attempt + 1, max_retries + 1, exc, delay
+        )
+
+
+def _exceeds_deadline(
+    exc: Exception,
+    attempt: int,
+    total_timeout: Optional[float],
+    elapsed: float,
+    delay: float
+) -> bool:
+    """True if sleeping ``delay`` would start the next attempt past the overall budget"""
+    if total_timeout is None:
+        return False
+    remaining = total_timeout - elapsed
+    if delay >= remaining:
+        logger.error(
+            "Attempt %d failed: %s. Giving up: retry in %.1fs would exceed "
+            "the %.1fs budget (%.1fs left)",
+            attempt + 1, exc, delay, total_timeout, max(remaining, 0.0)
+        )
+        return True
+    return False
+
+
 def retry_with_backoff(
     max_retries: int = 3,
     initial_delay: float = 1.0,
     max_delay: float = 60.0,
     exponential_base: float = 2.0,
-    exceptions: tuple = (Exception,)
+    exceptions: tuple = (Exception,),
+    jitter: bool = True,
+    total_timeout: Optional[float] = None
 ):
     """
     Decorator for retrying functions with exponential backoff.
@@ -29,6 +154,9 @@ def retry_with_backoff(
         max_delay: Maximum delay in seconds
         exponential_base: Multiplier for exponential backoff
         exceptions: Tuple of exception types to catch and retry
+        jitter: Randomize delays (Full Jitter) to avoid synchronized retries
+        total_timeout: Overall budget in seconds across all attempts; a retry
+            whose delay would run past it raises the last error instead
 
     Returns:
         Decorated function with retry logic
@@ -36,72 +164,40 @@ def retry_with_backoff(
     def decorator(func: Callable[..., T]) -> Callable[..., T]:
         @wraps(func)
         def sync_wrapper(*args, **kwargs) -> T:
-            delay = initial_delay
-            last_exception = None
-
+            start = time.monotonic()
             for attempt in range(max_retries + 1):
                 try:
                     return func(*args, **kwargs)
                 except exceptions as e:
-                    last_exception = e
-
-                    # Check if it's a rate limit error (HTTP 429)
-                    if hasattr(e, 'status_code') and e.status_code == 429:
-                        # For rate limits, use longer backoff
-                        retry_after = getattr(e, 'retry_after', delay)
-                        delay = min(retry_after, max_delay)
-                        logger.warning(
-                            f"Rate limit hit on attempt {attempt + 1}/{max_retries + 1}. "
-                            f"Retrying after {delay:.1f}s..."
-                        )
-                    else:
-                        logger.warning(
-                            f"Attempt {attempt + 1}/{max_retries + 1} failed: {str(e)}. "
-                            f"Retrying in {delay:.1f}s..."
-                        )
-
-                    if attempt < max_retries:
-                        time.sleep(delay)
-                        delay = min(delay * exponential_base, max_delay)
-                    else:
-                        logger.error(f"All {max_retries + 1} attempts failed")
-                        raise last_exception
-
-            raise last_exception
+                    if attempt >= max_retries:
+                        logger.error("All %d attempts failed", max_retries + 1)
+                        raise
+                    delay = _plan_next_delay(
+                        e, attempt, initial_delay, exponential_base, max_delay, jitter
+                    )
+                    if _exceeds_deadline(e, attempt, total_timeout, time.monotonic() - start, delay):
+                        raise
+                    _log_retry(e, attempt, max_retries, delay)
+                    time.sleep(delay)
 
         @wraps(func)
         async def async_wrapper(*args, **kwargs) -> T:
-            delay = initial_delay
-            last_exception = None
-
+            loop = asyncio.get_running_loop()
+            start = loop.time()
             for attempt in range(max_retries + 1):
                 try:
                     return await func(*args, **kwargs)
                 except exceptions as e:
-                    last_exception = e
-
-                    # Check if it's a rate limit error
-                    if hasattr(e, 'status_code') and e.status_code == 429:
-                        retry_after = getattr(e, 'retry_after', delay)
-                        delay = min(retry_after, max_delay)
-                        logger.warning(
-                            f"Rate limit hit on attempt {attempt + 1}/{max_retries + 1}. "
-                            f"Retrying after {delay:.1f}s..."
-                        )
-                    else:
-                        logger.warning(
-                            f"Attempt {attempt + 1}/{max_retries + 1} failed: {str(e)}. "
-                            f"Retrying in {delay:.1f}s..."
-                        )
-
-                    if attempt < max_retries:
-                        await asyncio.sleep(delay)
-                        delay = min(delay * exponential_base, max_delay)
-                    else:
-                        logger.error(f"All {max_retries + 1} attempts failed")
-                        raise last_exception
-
-            raise last_exception
+                    if attempt >= max_retries:
+                        logger.error("All %d attempts failed", max_retries + 1)
+                        raise
+                    delay = _plan_next_delay(
+                        e, attempt, initial_delay, exponential_base, max_delay, jitter
+                    )
+                    if _exceeds_deadline(e, attempt, total_timeout, loop.time() - start, delay):
+                        raise
+                    _log_retry(e, attempt, max_retries, delay)
+                    await asyncio.sleep(delay)
 
         # Return appropriate wrapper based on whether function is async
         if asyncio.iscoroutinefunction(func):
@@ -119,7 +215,12 @@ class CircuitBreaker:
     States:
     - CLOSED: Normal operation, requests pass through
     - OPEN: Too many failures, all requests fail fast
-    - HALF_OPEN: Testing if service recovered
+    - HALF_OPEN: Testing if service recovered (one probe call at a time)
+
+    State transitions happen under a lock so concurrent threads cannot race
+    the OPEN transition or send multiple HALF_OPEN probes. The CLOSED fast
+    path reads the state without locking, and the wrapped call itself never
+    runs under the lock.
     """
 
     def __init__(
@@ -136,72 +237,94 @@ class CircuitBreaker:
         self.last_failure_time: Optional[float] = None
         self.state = "CLOSED"  # CLOSED, OPEN, HALF_OPEN
 
-    def call(self, func: Callable[..., T], *args, **kwargs) -> T:
-        """Execute function through circuit breaker"""
-        if self.state == "OPEN":
-            # Check if we should try to recover
-            if time.time() - self.last_failure_time >= self.recovery_timeout:
+        self._state_lock = threading.Lock()
+        self._probe_in_flight = False
+
+    def _before_call(self) -> bool:
+        """Admit or reject a call. Returns True if the call is the HALF_OPEN probe."""
+        if self.state == "CLOSED":
+            return False
+
+        with self._state_lock:
+            if self.state == "OPEN":
+                # Check if we should try to recover
+                elapsed = time.time() - self.last_failure_time
+                if elapsed < self.recovery_timeout:
+                    raise Exception(
+                        f"Circuit breaker is OPEN. Service unavailable. "
+                        f"Retry after {self.recovery_timeout - elapsed:.0f}s"
+                    )
                 self.state = "HALF_OPEN"
                 logger.info("Circuit breaker entering HALF_OPEN state")
-            else:
-                raise Exception(
-                    f"Circuit breaker is OPEN. Service unavailable. "
-                    f"Retry after {self.recovery_timeout - (time.time() - self.last_failure_time):.0f}s"
-                )
-
-        try:
-            result = func(*args, **kwargs)
 
-            # Success - reset on HALF_OPEN
             if self.state == "HALF_OPEN":
-                self.state = "CLOSED"
-                self.failure_count = 0
-                logger.info("Circuit breaker recovered, state: CLOSED")
-
-            return result
-
-        except self.expected_exception as e:
+                if self._probe_in_flight:
+                    raise Exception(
+                        "Circuit breaker is HALF_OPEN. Recovery probe in progress."
+                    )
+                self._probe_in_flight = True
+                return True
+
+        return False
+
+    def _on_success(self, is_probe: bool) -> None:
+        """Close the circuit after a successful probe"""
+        if not is_probe:
+            return
+        with self._state_lock:
+            self.state = "CLOSED"
+            self.failure_count = 0
+            self._probe_in_flight = False
+            logger.info("Circuit breaker recovered, state: CLOSED")
+
+    def _on_failure(self, is_probe: bool) -> None:
+        """Record a failure and open the circuit on the threshold or a failed probe"""
+        with self._state_lock:
             self.failure_count += 1
             self.last_failure_time = time.time()
 
-            if self.failure_count >= self.failure_threshold:
+            if is_probe:
+                self._probe_in_flight = False
+                self.state = "OPEN"
+                logger.error("Circuit breaker probe failed, state: OPEN")
+            elif self.state == "CLOSED" and self.failure_count >= self.failure_threshold:
                 self.state = "OPEN"
                 logger.error(
                     f"Circuit breaker opened after {self.failure_count} failures"
                 )
 
-            raise e
+    def _release_probe(self, is_probe: bool) -> None:
+        """Free the probe slot after an unexpected exception, staying HALF_OPEN"""
+        if is_probe:
+            with self._state_lock:
+                self._probe_in_flight = False
+
+    def call(self, func: Callable[..., T], *args, **kwargs) -> T:
+        """Execute function through circuit breaker"""
+        is_probe = self._before_call()
+        try:
+            result = func(*args, **kwargs)
+        except self.expected_exception:
+            self._on_failure(is_probe)
+            raise
+        except BaseException:
+            self._release_probe(is_probe)
+            raise
+
+        self._on_success(is_probe)
+        return result
 
     async def call_async(self, func: Callable[..., T], *args, **kwargs) -> T:
         """Execute async function through circuit breaker"""
-        if self.state == "OPEN":
-            if time.time() - self.last_failure_time >= self.recovery_timeout:
-                self.state = "HALF_OPEN"
-                logger.info("Circuit breaker entering HALF_OPEN state")
-            else:
-                raise Exception(
-                    f"Circuit breaker is OPEN. Service unavailable. "
-                    f"Retry after {self.recovery_timeout - (time.time() - self.last_failure_time):.0f}s"
-                )
-
+        is_probe = self._before_call()
         try:
             result = await func(*args, **kwargs)
-
-            if self.state == "HALF_OPEN":
-                self.state = "CLOSED"
-                self.failure_count = 0
-                logger.info("Circuit breaker recovered, state: CLOSED")
-
-            return result
-
-        except self.expected_exception as e:
-            self.failure_count += 1
-            self.last_failure_time = time.time()
-
-            if self.failure_count >= self.failure_threshold:
-                self.state = "OPEN"
-                logger.error(
-                    f"Circuit breaker opened after {self.failure_count} failures"
-                )
-
-            raise e
+        except self.expected_exception:
+            self._on_failure(is_probe)
+            raise
+        except BaseException:
+            self._release_probe(is_probe)
+            raise
+
+        self._on_success(is_probe)
+        return result
@@ -3,82 +3,121 @@ Input validation utilities for secure file upload and request validation
 """
 
 import os
-import imghdr
 from typing import Tuple, Optional
 from werkzeug.datastructures import FileStorage
 
 
-# Allowed MIME types and their magic bytes
-ALLOWED_IMAGE_TYPES = {
-    'image/jpeg': [b'\xFF\xD8\xFF'],
-    'image/png': [b'\x89\x50\x4E\x47\x0D\x0A\x1A\x0A'],
-    'image/webp': [b'RIFF', b'WEBP'],
+# Allowed MIME types keyed by their leading magic bytes. WebP is 'RIFF', a
+# 4-byte size, then 'WEBP' at offset 8, so it is checked separately.
+IMAGE_SIGNATURES = {
+    b'\xFF\xD8\xFF': 'image/jpeg',
+    b'\x89\x50\x4E\x47\x0D\x0A\x1A\x0A': 'image/png',
 }
+_SIGNATURE_LENGTHS = tuple(sorted({len(sig) for sig in IMAGE_SIGNATURES}))
+
+# Only this many leading bytes are read for validation (covers RIFF....WEBP)
+MAGIC_HEADER_SIZE = max(_SIGNATURE_LENGTHS + (12,))
 
 # Maximum file sizes
 MAX_IMAGE_SIZE_MB = int(os.getenv('MAX_IMAGE_SIZE_MB', 16))
 MAX_IMAGE_SIZE_BYTES = MAX_IMAGE_SIZE_MB * 1024 * 1024
 
-# Allowed values for enums
-ALLOWED_FACILITIES = ['hongkong', 'shenzhen', 'yangjiang']
-ALLOWED_PRODUCT_SKUS = [
+# Allowed values for enums (sets for O(1) membership checks)
+ALLOWED_EXTENSIONS = frozenset({'jpg', 'jpeg', 'png', 'webp'})
+ALLOWED_FACILITIES = frozenset({'hongkong', 'shenzhen', 'yangjiang'})
+ALLOWED_PRODUCT_SKUS = frozenset({
     'WK-KN-200', 'WK-KN-150', 'WK-KN-100',
     'WK-SC-200', 'WK-CI-200', 'WK-CI-280'
-]
+})
 
+# Error messages are constant, so build them once
+_EXTENSIONS_ERR = f"Invalid file extension. Allowed: {', '.join(sorted(ALLOWED_EXTENSIONS))}"
+_FACILITIES_ERR = f"Invalid facility. Allowed: {', '.join(sorted(ALLOWED_FACILITIES))}"
+_PRODUCT_SKUS_ERR = f"Invalid product SKU. Allowed: {', '.join(sorted(ALLOWED_PRODUCT_SKUS))}"
 
-def validate_image_file(file: FileStorage) -> Tuple[bool, Optional[str]]:
+# Characters stripped from uploaded filenames
+_FILENAME_DELETE_TABLE = str.maketrans('', '', '\x00/\\')
+
+
+def detect_image_type(head: bytes) -> Optional[str]:
     """
-    Validate uploaded image file using magic bytes and file properties.
+    Identify an allowed image type from the first MAGIC_HEADER_SIZE bytes.
 
     Args:
-        file: Uploaded file from Flask request
+        head: Leading bytes of the file
 
     Returns:
-        Tuple of (is_valid, error_message)
+        MIME type, or None if the signature is not an allowed image format
     """
-    if not file or not file.filename:
-        return False, "No file provided"
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image/webp'
+    for length in _SIGNATURE_LENGTHS:
+        mime_type = IMAGE_SIGNATURES.get(head[:length])
+        if mime_type:
+            return mime_type
+    return None
 
-    # Check file extension
-    allowed_extensions = {'jpg', 'jpeg', 'png', 'webp'}
-    ext = file.filename.rsplit('.', 1)[-1].lower() if '.' in file.filename else ''
-    if ext not in allowed_extensions:
-        return False, f"Invalid file extension. Allowed: {', '.join(allowed_extensions)}"
 
-    # Read file content for validation
-    file_content = file.read()
-    file.seek(0)  # Reset file pointer for later use
+def _check_image(filename: str, head: bytes, file_size: int) -> Tuple[bool, Optional[str]]:
+    """Extension, size and signature checks shared by the file and bytes validators"""
+    # Check file extension
+    ext = filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+    if ext not in ALLOWED_EXTENSIONS:
+        return False, _EXTENSIONS_ERR
 
-    # Check file size
-    file_size = len(file_content)
     if file_size == 0:
         return False, "Empty file"
     if file_size > MAX_IMAGE_SIZE_BYTES:
         return False, f"File too large. Maximum size: {MAX_IMAGE_SIZE_MB}MB"
 
     # Validate magic bytes (file signature)
-    is_valid_type = False
-    for mime_type, magic_signatures in ALLOWED_IMAGE_TYPES.items():
-        for magic in magic_signatures:
-            if file_content.startswith(magic):
-                is_valid_type = True
-                break
-        if is_valid_type:
-            break
-
-    if not is_valid_type:
+    if detect_image_type(head) is None:
         return False, "Invalid file type. File signature does not match allowed image formats."
 
-    # Additional validation using imghdr
-    file.seek(0)
-    detected_type = imghdr.what(file)
-    file.seek(0)
+    return True, None
 
-    if detected_type not in ['jpeg', 'png', 'webp']:
-        return False, f"File validation failed. Detected type: {detected_type}"
 
-    return True, None
+def validate_image_file(file: FileStorage) -> Tuple[bool, Optional[str]]:
+    """
+    Validate uploaded image file using magic bytes and file properties.
+
+    Args:
+        file: Uploaded file from Flask request
+
+    Returns:
+        Tuple of (is_valid, error_message)
+    """
+    if not file or not file.filename:
+        return False, "No file provided"
+
+    # Read only the header for the signature check; the upload stays on disk
+    # (or in Werkzeug's spooled buffer) until it is copied to its destination
+    stream = file.stream
+    head = stream.read(MAGIC_HEADER_SIZE)
+
+    # Check file size without reading the body
+    stream.seek(0, os.SEEK_END)
+    file_size = stream.tell()
+    stream.seek(0)  # Reset file pointer for later use
+
+    return _check_image(file.filename, head, file_size)
+
+
+def validate_image_bytes(data: bytes, filename: str) -> Tuple[bool, Optional[str]]:
+    """
+    Validate an image already read into memory.
+
+    Args:
+        data: Full image content
+        filename: Original filename, for the extension check
+
+    Returns:
+        Tuple of (is_valid, error_message)
+    """
+    if not filename:
+        return False, "No file provided"
+
+    return _check_image(filename, data[:MAGIC_HEADER_SIZE], len(data))
 
 
 def validate_facility(facility: str) -> Tuple[bool, Optional[str]]:
@@ -96,7 +135,7 @@ def validate_facility(facility: str) -> Tuple[bool, Optional[str]]:
 
     facility = facility.lower().strip()
     if facility not in ALLOWED_FACILITIES:
-        return False, f"Invalid facility. Allowed: {', '.join(ALLOWED_FACILITIES)}"
+        return False, _FACILITIES_ERR
 
     return True, None
 
@@ -116,7 +155,7 @@ def validate_product_sku(sku: str) -> Tuple[bool, Optional[str]]:
 
     sku = sku.upper().strip()
     if sku not in ALLOWED_PRODUCT_SKUS:
-        return False, f"Invalid product SKU. Allowed: {', '.join(ALLOWED_PRODUCT_SKUS)}"
+        return False, _PRODUCT_SKUS_ERR
 
     return True, None
 
@@ -131,15 +170,12 @@ def sanitize_filename(filename: str) -> str:
     Returns:
         Sanitized filename
     """
-    # Remove path components
-    filename = os.path.basename(filename)
-
-    # Remove any null bytes
-    filename = filename.replace('\0', '')
+    # Remove path components, then null bytes and any remaining separators
+    # (e.g. Windows backslashes) in a single pass
+    filename = os.path.basename(filename).translate(_FILENAME_DELETE_TABLE)
 
     # Limit length
-    if len(filename) > 255:
-        name, ext = os.path.splitext(filename)
-        filename = name[:250] + ext
-
-    return filename
+    if len(filename) <= 255:
+        return filename
+    name, ext = os.path.splitext(filename)
+    return name[:255 - len(ext)] + ext
@@ -4,64 +4,158 @@ Enhanced with security, validation, and proper async handling
 """
 
 import asyncio
-import json
+import hashlib
 import logging
 import tempfile
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from operator import itemgetter
+from typing import Optional
+import orjson
+from cachetools import TTLCache
 from flask import Blueprint, request, jsonify, current_app
 from agents.defect_analyzer_gpt52 import WikoDefectAnalyzerGPT52, DefectAnalysis, DefectType, Severity, ProductionStage
 from utils.validation import (
     validate_image_file,
     validate_facility,
     validate_product_sku,
-    sanitize_filename
+    sanitize_filename,
+    MAX_IMAGE_SIZE_BYTES,
+    MAX_IMAGE_SIZE_MB
 )
 from utils.auth import require_api_key
+from utils.concurrency_limiter import limit_concurrency
 
 # Set up logging
 logger = logging.getLogger(__name__)
 
 analysis_bp = Blueprint('analysis_bp', __name__)
-analyzer = WikoDefectAnalyzerGPT52()
+
+# Built on first use, not at import, so worker boot doesn't pay for client setup
+_analyzer: Optional[WikoDefectAnalyzerGPT52] = None
+_analyzer_lock = threading.Lock()
+
+
+def get_analyzer() -> WikoDefectAnalyzerGPT52:
+    """Return the process-wide analyzer, creating it on first call"""
+    global _analyzer
+    if _analyzer is None:
+        with _analyzer_lock:
+            if _analyzer is None:
+                _analyzer = WikoDefectAnalyzerGPT52()
+    return _analyzer
+
+
+# Maximum model calls in flight for a single batch request
+MAX_CONCURRENCY = int(os.getenv('ANALYZE_CONCURRENCY', 8))
+
+MAX_BATCH_SIZE = int(os.getenv('MAX_BATCH_SIZE', 50))
+
+# Directory for staged uploads; the system temp dir unless UPLOAD_TMPDIR is
+# set. Pointing it at /dev/shm keeps uploads off disk, but Docker's default
+# shm is 64MB: size it (--shm-size) for workers x threads x 16MB first.
+_TMPDIR = os.getenv('UPLOAD_TMPDIR') or None
+
+# Recent successful /analyze responses keyed by image content and request
+# parameters, so retries and reused reference shots skip the model call.
+# Per worker process; failures are never cached.
+_RESULT_CACHE = TTLCache(
+    maxsize=int(os.getenv('RESULT_CACHE_SIZE', 2048)),
+    ttl=int(os.getenv('RESULT_CACHE_TTL', 3600))
+)
+_result_cache_lock = threading.Lock()
+
+
+def _save_upload(stream, dst) -> str:
+    """Copy an upload to dst in 64KB chunks, returning its blake2b content hash"""
+    hasher = hashlib.blake2b(digest_size=16)
+    while chunk := stream.read(65536):
+        hasher.update(chunk)
+        dst.write(chunk)
+    return hasher.hexdigest()
+
 
 # Get limiter from app context (will be registered by app.py)
 def get_limiter():
     """Get rate limiter from Flask app context"""
     return current_app.extensions.get('limiter')
 
-# Shared event loop for async operations
-_event_loop = None
-
-def get_event_loop():
-    """Get or create a shared event loop for async operations"""
-    global _event_loop
-    if _event_loop is None or _event_loop.is_closed():
-        _event_loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(_event_loop)
-    return _event_loop
-
-def cleanup_event_loop():
-    """Cleanup shared event loop on application shutdown"""
-    global _event_loop
-    if _event_loop and not _event_loop.is_closed():
+# Long-lived event loop running on a background thread. Request threads submit
+# coroutines to it, so concurrent requests never touch a loop from two threads
+# and in-flight analyses from all requests overlap on one loop.
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_thread: Optional[threading.Thread] = None
+_loop_lock = threading.Lock()
+
+
+def _get_background_loop() -> asyncio.AbstractEventLoop:
+    """Start the background event loop on first use (after any gunicorn fork)"""
+    global _loop, _loop_thread
+    if _loop is None:
+        with _loop_lock:
+            if _loop is None:
+                loop = asyncio.new_event_loop()
+                # Blocking model calls run via asyncio.to_thread on this executor
+                loop.set_default_executor(ThreadPoolExecutor(
+                    max_workers=int(os.getenv('ANALYZER_IO_THREADS', 32)),
+                    thread_name_prefix='analyzer-io'
+                ))
+                _loop_thread = threading.Thread(
+                    target=loop.run_forever,
+                    name='analyzer-event-loop',
+                    daemon=True
+                )
+                _loop_thread.start()
+                _loop = loop
+    return _loop
+
+
+def run_async(coro):
+    """Run a coroutine on the background loop and block until it completes"""
+    return asyncio.run_coroutine_threadsafe(coro, _get_background_loop()).result()
+
+
+async def _analyze_bounded(image_paths, product_sku, facility):
+    """
+    Analyze images concurrently, at most MAX_CONCURRENCY at a time.
+
+    Returns one entry per path, in order: a DefectAnalysis or the exception
+    that image raised, so one failure does not sink the whole batch.
+    """
+    analyzer = get_analyzer()
+    sem = asyncio.Semaphore(MAX_CONCURRENCY)
+
+    async def _one(path):
+        async with sem:
+            return await analyzer.analyze_defect(path, product_sku, facility, None)
+
+    return await asyncio.gather(*[_one(p) for p in image_paths], return_exceptions=True)
+
+
+def shutdown_async_runner():
+    """Stop the background loop and its executor on application shutdown"""
+    global _loop, _loop_thread
+    with _loop_lock:
+        if _loop is None:
+            return
         try:
-            # Cancel all pending tasks
-            pending = asyncio.all_tasks(_event_loop)
-            for task in pending:
-                task.cancel()
-            # Run until all tasks are cancelled
-            _event_loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
-            _event_loop.close()
+            _loop.call_soon_threadsafe(_loop.stop)
+            _loop_thread.join(timeout=5)
+            _loop.run_until_complete(_loop.shutdown_default_executor())
+            _loop.close()
             logger.info("Event loop cleaned up successfully")
         except Exception as e:
             logger.error(f"Error cleaning up event loop: {e}")
         finally:
-            _event_loop = None
+            _loop = None
+            _loop_thread = None
 
 
 @analysis_bp.route('/analyze', methods=['POST'])
 @require_api_key
+@limit_concurrency
 def analyze_defect():
     """
     Analyze a single product image for defects.
@@ -105,8 +199,8 @@ def analyze_defect():
     production_data = None
     if 'production_data' in request.form:
         try:
-            production_data = json.loads(request.form['production_data'])
-        except json.JSONDecodeError as e:
+            production_data = orjson.loads(request.form['production_data'])
+        except orjson.JSONDecodeError as e:
             logger.warning(f"Invalid production_data JSON: {e}")
             return jsonify({"error": "Invalid production_data JSON format"}), 400
 
@@ -117,15 +211,23 @@ def analyze_defect():
         with tempfile.NamedTemporaryFile(
             suffix='.jpg',
             delete=False,
-            prefix='wiko_analysis_'
+            prefix='wiko_analysis_',
+            dir=_TMPDIR
         ) as tmp:
-            file.save(tmp.name)
+            # Stream the upload to disk, hashing it on the way
             temp_path = tmp.name
-
-        # Run async analysis using shared event loop
-        loop = get_event_loop()
-        result = loop.run_until_complete(
-            analyzer.analyze_defect(
+            content_hash = _save_upload(file.stream, tmp)
+
+        cache_key = (content_hash, product_sku, facility, request.form.get('production_data'))
+        with _result_cache_lock:
+            cached = _RESULT_CACHE.get(cache_key)
+        if cached is not None:
+            logger.info(f"Analysis cache hit: {content_hash}")
+            return jsonify(cached)
+
+        # Run async analysis on the background event loop
+        result = run_async(
+            get_analyzer().analyze_defect(
                 image_path=temp_path,
                 product_sku=product_sku,
                 facility=facility,
@@ -134,7 +236,10 @@ def analyze_defect():
         )
 
         logger.info(f"Analysis complete: {result.defect_id}, defect_detected={result.defect_detected}")
-        return jsonify({"success": True, "analysis": result.to_dict()})
+        payload = {"success": True, "analysis": result.to_dict()}
+        with _result_cache_lock:
+            _RESULT_CACHE[cache_key] = payload
+        return jsonify(payload)
 
     except asyncio.TimeoutError:
         logger.error("Analysis timed out")
@@ -145,6 +250,8 @@ def analyze_defect():
 
     except ValueError as e:
         logger.error(f"Validation error: {e}")
+        # Not cached: the analyzer also raises ValueError for transient model
+        # failures (empty or malformed responses), which a retry can fix
         return jsonify({"success": False, "error": str(e)}), 400
 
     except Exception as e:
@@ -164,14 +271,61 @@ def analyze_defect():
                 logger.warning(f"Failed to delete temp file {temp_path}: {e}")
 
 
+def _validate_and_save(idx, file):
+    """
+    Validate one batch upload and copy it to a temp file.
+
+    Returns:
+        Tuple of (temp_path, content_hash, error_message); either the path
+        and hash or the error message is set
+    """
+    if not file or file.filename == '':
+        return None, None, f"File {idx + 1}: No file selected"
+
+    # Validate image file
+    is_valid, error_msg = validate_image_file(file)
+    if not is_valid:
+        return None, None, f"File {idx + 1} ({file.filename}): {error_msg}"
+
+    # Save to temp file
+    temp_path = None
+    try:
+        with tempfile.NamedTemporaryFile(
+            suffix='.jpg',
+            delete=False,
+            prefix=f'wiko_batch_{idx}_',
+            dir=_TMPDIR
+        ) as tmp:
+            temp_path = tmp.name
+            content_hash = _save_upload(file.stream, tmp)
+        return temp_path, content_hash, None
+    except Exception as e:
+        logger.error(f"Failed to save file {file.filename}: {e}")
+        if temp_path and os.path.exists(temp_path):
+            os.unlink(temp_path)
+        return None, None, f"File {idx + 1}: Failed to save"
+
+
+def _batch_slots() -> int:
+    """Concurrency slots for a batch: one per model call it can have in flight"""
+    return min(len(request.files.getlist('images')), MAX_CONCURRENCY)
+
+
+# A full batch runs in waves of MAX_CONCURRENCY calls; its slots must outlive
+# every wave, or the limiter reclaims them while the batch is still running
+_BATCH_WAVES = -(-MAX_BATCH_SIZE // MAX_CONCURRENCY)
+
+
 @analysis_bp.route('/analyze/batch', methods=['POST'])
 @require_api_key
+@limit_concurrency(slots=_batch_slots, ttl_multiplier=_BATCH_WAVES)
 def analyze_batch():
     """
     Analyze multiple product images in batch.
 
     Request:
-        - images: Multiple image files
+        - images: Multiple image files (up to MAX_BATCH_SIZE; the whole
+          body is capped by the app-wide MAX_CONTENT_LENGTH, 16MB)
         - product_sku: Product SKU (required)
         - facility: Facility code (optional, default: yangjiang)
 
@@ -186,10 +340,9 @@ def analyze_batch():
         return jsonify({"error": "No files selected"}), 400
 
     # Check batch size limit
-    max_batch_size = int(os.getenv('MAX_BATCH_SIZE', 50))
-    if len(files) > max_batch_size:
+    if len(files) > MAX_BATCH_SIZE:
         return jsonify({
-            "error": f"Batch size exceeds limit. Maximum: {max_batch_size} images"
+            "error": f"Batch size exceeds limit. Maximum: {MAX_BATCH_SIZE} images"
         }), 400
 
     # Validate product SKU (required for batch)
@@ -206,31 +359,22 @@ def analyze_batch():
 
     # Validate and save all files to temp locations
     temp_paths = []
+    filenames = []
+    content_hashes = []
     validation_errors = []
 
-    for idx, file in enumerate(files):
-        if not file or file.filename == '':
-            validation_errors.append(f"File {idx + 1}: No file selected")
-            continue
-
-        # Validate image file
-        is_valid, error_msg = validate_image_file(file)
-        if not is_valid:
-            validation_errors.append(f"File {idx + 1} ({file.filename}): {error_msg}")
-            continue
+    # Each upload is its own spooled stream, so they can be validated and
+    # written to disk in parallel
+    with ThreadPoolExecutor(max_workers=min(16, len(files))) as pool:
+        saved = list(pool.map(_validate_and_save, range(len(files)), files))
 
-        # Save to temp file
-        try:
-            with tempfile.NamedTemporaryFile(
-                suffix='.jpg',
-                delete=False,
-                prefix=f'wiko_batch_{idx}_'
-            ) as tmp:
-                file.save(tmp.name)
-                temp_paths.append(tmp.name)
-        except Exception as e:
-            logger.error(f"Failed to save file {file.filename}: {e}")
-            validation_errors.append(f"File {idx + 1}: Failed to save")
+    for file, (temp_path, content_hash, error_msg) in zip(files, saved):
+        if error_msg:
+            validation_errors.append(error_msg)
+        else:
+            temp_paths.append(temp_path)
+            filenames.append(file.filename)
+            content_hashes.append(content_hash)
 
     # Return validation errors if any
     if validation_errors:
@@ -249,25 +393,62 @@ def analyze_batch():
         return jsonify({"error": "No valid image files provided"}), 400
 
     try:
-        # Run async batch analysis
-        loop = get_event_loop()
-        results = loop.run_until_complete(
-            analyzer.analyze_batch(
-                image_paths=temp_paths,
-                product_sku=product_sku,
-                facility=facility
-            )
+        # Analyze each distinct image once; duplicates in the batch (e.g. a
+        # repeated frame) share the result of their first occurrence
+        unique_paths = {}
+        for content_hash, temp_path in zip(content_hashes, temp_paths):
+            unique_paths.setdefault(content_hash, temp_path)
+
+        # Run async batch analysis with bounded concurrency
+        unique_outcomes = run_async(
+            _analyze_bounded(list(unique_paths.values()), product_sku, facility)
+        )
+        outcome_by_hash = dict(zip(unique_paths, unique_outcomes))
+
+        # Partition successes from per-image failures
+        results = []
+        result_hashes = []
+        analysis_errors = []
+        for idx, (filename, content_hash) in enumerate(zip(filenames, content_hashes)):
+            outcome = outcome_by_hash[content_hash]
+            if isinstance(outcome, BaseException):
+                logger.error(f"Analysis failed for {filename}: {outcome}", exc_info=outcome)
+                analysis_errors.append({
+                    "index": idx,
+                    "filename": filename,
+                    "content_hash": content_hash,
+                    "error": "Analysis timed out" if isinstance(outcome, asyncio.TimeoutError)
+                    else "Analysis failed"
+                })
+            else:
+                results.append(outcome)
+                result_hashes.append(content_hash)
+
+        if not results:
+            return jsonify({
+                "success": False,
+                "error": "Analysis failed for every image in the batch",
+                "errors": analysis_errors
+            }), 500
+
+        # Summarize each distinct image once, so duplicates in the batch do
+        # not inflate defect counts
+        unique_results = [o for o in unique_outcomes if not isinstance(o, BaseException)]
+        summary = get_analyzer().generate_shift_report(unique_results)
+
+        logger.info(
+            f"Batch analysis complete: {len(results)} images ({len(unique_paths)} unique), "
+            f"{len(analysis_errors)} failed, {summary['total_defects']} defects"
         )
-
-        # Generate summary report
-        summary = analyzer.generate_shift_report(results)
-
-        logger.info(f"Batch analysis complete: {len(results)} images, {summary['total_defects']} defects")
 
         return jsonify({
             "success": True,
             "count": len(results),
-            "analyses": [r.to_dict() for r in results],
+            "unique_count": len(unique_paths),
+            "analyses": [
+                {**r.to_dict(), "content_hash": h} for r, h in zip(results, result_hashes)
+            ],
+            "errors": analysis_errors,
             "summary": summary
         })
 
@@ -295,6 +476,16 @@ def analyze_batch():
                     logger.warning(f"Failed to delete temp file {temp_path}: {e}")
 
 
+# Fields every analysis posted to /shift-report must carry, in error-message order
+_REPORT_REQUIRED_FIELDS = ('defect_id', 'timestamp', 'facility', 'product_sku',
+                           'defect_detected', 'defect_type', 'severity', 'confidence')
+_REPORT_REQUIRED_SET = frozenset(_REPORT_REQUIRED_FIELDS)
+_get_report_fields = itemgetter(*_REPORT_REQUIRED_FIELDS)
+
+# Largest /shift-report body accepted, checked before the body is parsed
+MAX_REPORT_BYTES = int(os.getenv('MAX_REPORT_SIZE_MB', 10)) * 1024 * 1024
+
+
 @analysis_bp.route('/shift-report', methods=['POST'])
 @require_api_key
 def generate_shift_report():
@@ -307,8 +498,23 @@ def generate_shift_report():
     Response:
         JSON with shift report
     """
-    data = request.get_json()
-    if not data or 'analyses' not in data:
+    if request.content_length and request.content_length > MAX_REPORT_BYTES:
+        return jsonify({"error": f"Request body too large. Maximum: {MAX_REPORT_BYTES} bytes"}), 413
+
+    # Same contract as request.get_json(): JSON content types only
+    if not request.is_json:
+        return jsonify({"error": "Content-Type must be application/json"}), 415
+
+    # Parse the raw body with orjson; nothing else reads it, so don't cache it
+    raw = request.get_data(cache=False)
+    if len(raw) > MAX_REPORT_BYTES:
+        return jsonify({"error": f"Request body too large. Maximum: {MAX_REPORT_BYTES} bytes"}), 413
+    try:
+        data = orjson.loads(raw) if raw else None
+    except orjson.JSONDecodeError:
+        return jsonify({"error": "Request body must be valid JSON"}), 400
+
+    if not isinstance(data, dict) or 'analyses' not in data:
         return jsonify({"error": "analyses array is required in request body"}), 400
 
     if not isinstance(data['analyses'], list):
@@ -316,30 +522,41 @@ def generate_shift_report():
 
     try:
         analyses = []
+        # Hoisted out of the loop; reports can carry thousands of analyses
+        get_required = _get_report_fields
+        required = _REPORT_REQUIRED_SET
+        from_iso = datetime.fromisoformat
+        DT, SV, PS = DefectType, Severity, ProductionStage
         for idx, a in enumerate(data['analyses']):
+            if not isinstance(a, dict):
+                return jsonify({"error": f"Analysis {idx + 1} must be an object"}), 400
+
             # Validate required fields
-            required_fields = ['defect_id', 'timestamp', 'facility', 'product_sku',
-                             'defect_detected', 'defect_type', 'severity', 'confidence']
-            missing_fields = [f for f in required_fields if f not in a]
-            if missing_fields:
+            missing = required - a.keys()
+            if missing:
+                missing_fields = [f for f in _REPORT_REQUIRED_FIELDS if f in missing]
                 return jsonify({
                     "error": f"Analysis {idx + 1} missing required fields: {', '.join(missing_fields)}"
                 }), 400
 
+            (defect_id, timestamp, facility, product_sku,
+             defect_detected, defect_type, severity, confidence) = get_required(a)
+            stage = a.get('probable_stage')
+
             # Create DefectAnalysis object
-            analysis = DefectAnalysis(
-                defect_id=a['defect_id'],
-                timestamp=datetime.fromisoformat(a['timestamp']),
-                facility=a['facility'],
-                product_sku=a['product_sku'],
-                defect_detected=a['defect_detected'],
-                defect_type=DefectType(a['defect_type']),
-                severity=Severity(a['severity']),
-                confidence=a['confidence'],
+            analyses.append(DefectAnalysis(
+                defect_id=defect_id,
+                timestamp=from_iso(timestamp),
+                facility=facility,
+                product_sku=product_sku,
+                defect_detected=defect_detected,
+                defect_type=DT(defect_type),
+                severity=SV(severity),
+                confidence=confidence,
                 description=a.get('description', ''),
                 affected_area=a.get('affected_area', ''),
                 bounding_box=a.get('bounding_box'),
-                probable_stage=ProductionStage(a['probable_stage']) if a.get('probable_stage') else None,
+                probable_stage=PS(stage) if stage else None,
                 root_cause=a.get('root_cause', ''),
                 five_why_chain=a.get('five_why_chain', []),
                 contributing_factors=a.get('contributing_factors', []),
@@ -347,11 +564,10 @@ def generate_shift_report():
                 preventive_actions=a.get('preventive_actions', []),
                 reasoning_tokens_used=a.get('reasoning_tokens_used', 0),
                 model_version=a.get('model_version', 'gpt-5.2')
-            )
-            analyses.append(analysis)
+            ))
 
         # Generate report
-        report = analyzer.generate_shift_report(analyses)
+        report = get_analyzer().generate_shift_report(analyses)
 
         logger.info(f"Shift report generated: {len(analyses)} analyses")
 
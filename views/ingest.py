@@ -3,50 +3,131 @@ Ingest endpoint for Azure-backed processing pipeline.
 Uploads raw images to Blob Storage and enqueues a Service Bus message.
 """
 
-import json
+import atexit
+import functools
 import logging
 import os
-import uuid
+import queue
+import threading
+import time
+from concurrent.futures import Future
 from datetime import datetime, timezone
-from typing import Optional
+from typing import Dict, List, Optional, Set, Tuple
 
+import orjson
+import requests
 from azure.core.exceptions import ResourceExistsError
+from azure.core.pipeline.transport import RequestsTransport
 from azure.identity import DefaultAzureCredential
-from azure.servicebus import ServiceBusClient, ServiceBusMessage
-from azure.storage.blob import BlobServiceClient, ContentSettings
+from azure.servicebus import ServiceBusClient, ServiceBusMessage, ServiceBusMessageBatch, ServiceBusSender
+from azure.servicebus.exceptions import MessageSizeExceededError
+from azure.storage.blob import BlobServiceClient, BlobType, ContainerClient, ContentSettings
 from flask import Blueprint, jsonify, request
+from requests.adapters import HTTPAdapter
+from ulid import ULID
+from urllib3.util.retry import Retry
 
 from utils.auth import require_api_key
-from utils.validation import validate_image_file, validate_facility, validate_product_sku
+from utils.azure_clients import get_credential
+from utils.validation import validate_image_bytes, validate_facility, validate_product_sku
 
 logger = logging.getLogger(__name__)
 
 ingest_bp = Blueprint("ingest_bp", __name__)
 
+# Read once at import; changing these requires a restart
+RAW_CONTAINER = os.getenv("AZURE_STORAGE_RAW_CONTAINER", "raw-images")
+PROCESSED_CONTAINER = os.getenv("AZURE_STORAGE_PROCESSED_CONTAINER", "processed-images")
+QUEUE_NAME = os.getenv("AZURE_SERVICEBUS_QUEUE", "defect-jobs")
+
 _blob_service_client: Optional[BlobServiceClient] = None
 _servicebus_client: Optional[ServiceBusClient] = None
 
+# Long-lived queue senders, one per queue, so requests reuse the AMQP link
+# instead of opening and tearing one down per message. Senders are not
+# thread-safe; only the send batcher's thread uses them.
+_sender_cache: Dict[str, ServiceBusSender] = {}
+_sender_lock = threading.Lock()
+
+# Queue sends from concurrent requests are coalesced into one batch per
+# SB_BATCH_INTERVAL_MS window, up to SB_BATCH_MAX messages
+SB_BATCH_MAX = int(os.getenv("SB_BATCH_MAX", "50"))
+SB_BATCH_INTERVAL = int(os.getenv("SB_BATCH_INTERVAL_MS", "20")) / 1000
+SB_SEND_TIMEOUT = float(os.getenv("SB_SEND_TIMEOUT", "10"))
+
+# Containers known to exist; checked once per process instead of per request
+_containers_ready: Set[str] = set()
+_containers_lock = threading.Lock()
+
+# Uploads above the single-PUT threshold are split into blocks of
+# max_block_size and staged on BLOB_UPLOAD_CONCURRENCY parallel connections
+_BLOB_CLIENT_OPTIONS = {
+    "max_single_put_size": int(os.getenv("AZURE_STORAGE_SINGLE_PUT_SIZE", 8 * 1024 * 1024)),
+    "max_block_size": int(os.getenv("AZURE_STORAGE_BLOB_CHUNK_SIZE", 4 * 1024 * 1024)),
+    # Storage's default backoff starts at 15s, far too long to hold a request
+    # thread; this retries after roughly 1s, 3s and 5s
+    "retry_total": 3,
+    "initial_backoff": 1,
+    "increment_base": 2,
+}
+BLOB_UPLOAD_CONCURRENCY = int(os.getenv("BLOB_UPLOAD_CONCURRENCY", "8"))
+_SERVICEBUS_CLIENT_OPTIONS = {
+    "retry_total": 3,
+    "retry_backoff_factor": 0.5,
+}
+
+# HTTP connections kept per storage host. requests pools only 10 by default,
+# fewer than gunicorn threads x BLOB_UPLOAD_CONCURRENCY, so uploads would
+# otherwise queue for a connection or open throwaway ones.
+HTTP_POOL_SIZE = int(os.getenv("AZURE_HTTP_POOL_SIZE", "64"))
+
+
+def _build_transport() -> RequestsTransport:
+    session = requests.Session()
+    # Retries are handled by the SDK's retry policy, not by urllib3
+    adapter = HTTPAdapter(
+        pool_maxsize=HTTP_POOL_SIZE,
+        max_retries=Retry(total=False, redirect=False, raise_on_status=False),
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return RequestsTransport(session=session)
 
-def _get_blob_service_client() -> BlobServiceClient:
-    global _blob_service_client
-    if _blob_service_client:
-        return _blob_service_client
 
+def _build_blob_service_client(credential=None, **kwargs) -> BlobServiceClient:
     conn_string = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
     account_name = os.getenv("AZURE_STORAGE_ACCOUNT")
+    options = {**_BLOB_CLIENT_OPTIONS, **kwargs}
 
     if conn_string:
-        _blob_service_client = BlobServiceClient.from_connection_string(conn_string)
-        return _blob_service_client
+        return BlobServiceClient.from_connection_string(conn_string, **options)
 
     if not account_name:
         raise ValueError("AZURE_STORAGE_ACCOUNT is required when no connection string is provided")
 
     account_url = f"https://{account_name}.blob.core.windows.net"
-    _blob_service_client = BlobServiceClient(account_url=account_url, credential=DefaultAzureCredential())
+    return BlobServiceClient(
+        account_url=account_url,
+        credential=credential or get_credential(),
+        **options,
+    )
+
+
+def _get_blob_service_client() -> BlobServiceClient:
+    global _blob_service_client
+    if _blob_service_client:
+        return _blob_service_client
+
+    _blob_service_client = _build_blob_service_client(transport=_build_transport())
     return _blob_service_client
 
 
+@functools.lru_cache(maxsize=8)
+def _container_client(container_name: str) -> ContainerClient:
+    """Per-container client; blob clients made from it share its pipeline"""
+    return _get_blob_service_client().get_container_client(container_name)
+
+
 def _get_servicebus_client() -> ServiceBusClient:
     global _servicebus_client
     if _servicebus_client:
@@ -56,7 +137,7 @@ def _get_servicebus_client() -> ServiceBusClient:
     namespace = os.getenv("AZURE_SERVICEBUS_NAMESPACE")
 
     if conn_string:
-        _servicebus_client = ServiceBusClient.from_connection_string(conn_string)
+        _servicebus_client = ServiceBusClient.from_connection_string(conn_string, **_SERVICEBUS_CLIENT_OPTIONS)
         return _servicebus_client
 
     if not namespace:
@@ -67,19 +148,194 @@ def _get_servicebus_client() -> ServiceBusClient:
 
     _servicebus_client = ServiceBusClient(
         fully_qualified_namespace=namespace,
-        credential=DefaultAzureCredential(),
+        credential=get_credential(),
+        **_SERVICEBUS_CLIENT_OPTIONS,
     )
     return _servicebus_client
 
 
-def _ensure_container_exists(container_name: str) -> None:
-    blob_service = _get_blob_service_client()
-    container_client = blob_service.get_container_client(container_name)
-    try:
-        container_client.create_container()
-    except ResourceExistsError:
+def _get_sender(queue_name: str) -> ServiceBusSender:
+    sender = _sender_cache.get(queue_name)
+    if sender is not None:
+        return sender
+
+    with _sender_lock:
+        sender = _sender_cache.get(queue_name)
+        if sender is None:
+            sender = _get_servicebus_client().get_queue_sender(queue_name=queue_name)
+            _sender_cache[queue_name] = sender
+    return sender
+
+
+class _SendBatcher:
+    """
+    Coalesces queue sends from concurrent requests into message batches.
+
+    A single daemon thread owns the sender: it takes the first queued
+    message, collects whatever else arrives within the flush interval (up
+    to max_messages) and sends them as one ServiceBusMessageBatch. Each
+    caller gets a Future that resolves once its batch is acknowledged.
+    The thread starts on first use, so with preload_app it runs in the
+    gunicorn worker rather than the master.
+    """
+
+    def __init__(self, queue_name: str, max_messages: int, interval: float):
+        self.queue_name = queue_name
+        self.max_messages = max(1, max_messages)
+        self.interval = interval
+        self._queue: "queue.Queue[Optional[Tuple[ServiceBusMessage, Future]]]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def submit(self, message: ServiceBusMessage) -> Future:
+        """Queue a message for the next batch"""
+        future: Future = Future()
+        self._ensure_started()
+        self._queue.put((message, future))
+        return future
+
+    def close(self, timeout: float = 5.0) -> None:
+        """Flush pending messages and stop the thread"""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _ensure_started(self) -> None:
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                thread = threading.Thread(
+                    target=self._run,
+                    name=f"sb-batcher-{self.queue_name}",
+                    daemon=True,
+                )
+                thread.start()
+                self._thread = thread
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+
+            pending = [item]
+            stopping = False
+            deadline = time.monotonic() + self.interval
+            while len(pending) < self.max_messages:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                pending.append(item)
+
+            self._send(pending)
+            if stopping:
+                return
+
+    def _send(self, pending: List[Tuple[ServiceBusMessage, Future]]) -> None:
+        try:
+            sender = _get_sender(self.queue_name)
+            batch = sender.create_message_batch()
+            batched: List[Future] = []
+            for message, future in pending:
+                try:
+                    batch.add_message(message)
+                except MessageSizeExceededError:
+                    # Batch is full: send it and start another
+                    self._flush(sender, batch, batched)
+                    batch = sender.create_message_batch()
+                    batched = []
+                    try:
+                        batch.add_message(message)
+                    except MessageSizeExceededError as exc:
+                        # Too large to send even on its own
+                        future.set_exception(exc)
+                        continue
+                batched.append(future)
+            self._flush(sender, batch, batched)
+        except Exception as exc:
+            logger.error("Service Bus batch send failed for %s: %s", self.queue_name, exc)
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(exc)
+
+    @staticmethod
+    def _flush(sender: ServiceBusSender, batch: ServiceBusMessageBatch, futures: List[Future]) -> None:
+        if not futures:
+            return
+        try:
+            sender.send_messages(batch)
+        except Exception as exc:
+            for future in futures:
+                future.set_exception(exc)
+            return
+        for future in futures:
+            future.set_result(None)
+
+
+_send_batcher = _SendBatcher(QUEUE_NAME, SB_BATCH_MAX, SB_BATCH_INTERVAL)
+
+
+@atexit.register
+def _close_servicebus() -> None:
+    _send_batcher.close()
+
+    for queue_name, sender in list(_sender_cache.items()):
+        try:
+            sender.close()
+        except Exception as exc:
+            logger.warning("Failed to close Service Bus sender for %s: %s", queue_name, exc)
+    _sender_cache.clear()
+
+    if _servicebus_client:
+        try:
+            _servicebus_client.close()
+        except Exception as exc:
+            logger.warning("Failed to close Service Bus client: %s", exc)
+
+
+def _ensure_container_exists(container_name: str, blob_service: Optional[BlobServiceClient] = None) -> None:
+    if container_name in _containers_ready:
         return
 
+    with _containers_lock:
+        if container_name in _containers_ready:
+            return
+        if blob_service is not None:
+            container_client = blob_service.get_container_client(container_name)
+        else:
+            container_client = _container_client(container_name)
+        try:
+            container_client.create_container()
+        except ResourceExistsError:
+            pass
+        _containers_ready.add(container_name)
+
+
+@ingest_bp.record_once
+def _prepare_containers(state) -> None:
+    """Create the default containers once at app startup, off the request path"""
+    if not (os.getenv("AZURE_STORAGE_CONNECTION_STRING") or os.getenv("AZURE_STORAGE_ACCOUNT")):
+        return
+
+    # A throwaway client and credential: with preload_app this runs in the
+    # gunicorn master, and workers should not inherit their connections
+    try:
+        with DefaultAzureCredential() as credential, \
+                _build_blob_service_client(credential) as blob_service:
+            for container_name in (RAW_CONTAINER, PROCESSED_CONTAINER):
+                _ensure_container_exists(container_name, blob_service)
+    except Exception as exc:
+        logger.warning("Could not prepare blob containers at startup, deferring to first request: %s", exc)
+
 
 @ingest_bp.route("/ingest", methods=["POST"])
 @require_api_key
@@ -100,7 +356,10 @@ def ingest_image():
     if not file or file.filename == "":
         return jsonify({"error": "No file selected"}), 400
 
-    is_valid, error_msg = validate_image_file(file)
+    # Read the upload once into memory (the body is capped by MAX_CONTENT_LENGTH);
+    # the same buffer is validated and uploaded
+    data = file.stream.read()
+    is_valid, error_msg = validate_image_bytes(data, file.filename)
     if not is_valid:
         logger.warning("Invalid file upload: %s", error_msg)
         return jsonify({"error": error_msg}), 400
@@ -118,18 +377,16 @@ def ingest_image():
     metadata = {}
     if request.form.get("metadata"):
         try:
-            metadata = json.loads(request.form["metadata"])
-        except json.JSONDecodeError:
+            metadata = orjson.loads(request.form["metadata"])
+        except orjson.JSONDecodeError:
             return jsonify({"error": "Invalid metadata JSON"}), 400
 
-    raw_container = os.getenv("AZURE_STORAGE_RAW_CONTAINER", "raw-images")
-    processed_container = os.getenv("AZURE_STORAGE_PROCESSED_CONTAINER", "processed-images")
-    queue_name = os.getenv("AZURE_SERVICEBUS_QUEUE", "defect-jobs")
+    _ensure_container_exists(RAW_CONTAINER)
+    _ensure_container_exists(PROCESSED_CONTAINER)
 
-    _ensure_container_exists(raw_container)
-    _ensure_container_exists(processed_container)
-
-    image_id = str(uuid.uuid4())
+    # ULIDs sort by creation time, so consecutive ingests get adjacent blob
+    # names; also used as the Service Bus message_id for duplicate detection
+    image_id = str(ULID())
     filename = file.filename or "upload.jpg"
     ext = os.path.splitext(filename)[1].lower()
     if not ext:
@@ -138,8 +395,7 @@ def ingest_image():
 
     received_at = datetime.now(timezone.utc).isoformat()
 
-    blob_service = _get_blob_service_client()
-    blob_client = blob_service.get_blob_client(container=raw_container, blob=blob_name)
+    blob_client = _container_client(RAW_CONTAINER).get_blob_client(blob_name)
 
     content_settings = ContentSettings(content_type=file.mimetype or "application/octet-stream")
     blob_metadata = {
@@ -149,43 +405,49 @@ def ingest_image():
         "received_at": received_at,
     }
 
-    file.stream.seek(0)
-    blob_client.upload_blob(
-        file.stream,
-        overwrite=True,
-        metadata=blob_metadata,
-        content_settings=content_settings,
-    )
-
+    # The message is fully serialized here, before any Azure call, so the
+    # batcher thread only ever adds ready-made bytes to a batch
     message_body = {
         "image_id": image_id,
         "blob_name": blob_name,
-        "raw_container": raw_container,
-        "processed_container": processed_container,
+        "raw_container": RAW_CONTAINER,
+        "processed_container": PROCESSED_CONTAINER,
         "product_sku": product_sku,
         "facility": facility,
         "received_at": received_at,
         "content_type": file.mimetype,
         "metadata": metadata,
     }
+    message = ServiceBusMessage(
+        orjson.dumps(message_body),
+        content_type="application/json",
+        message_id=image_id,
+    )
 
-    servicebus_client = _get_servicebus_client()
-    with servicebus_client:
-        sender = servicebus_client.get_queue_sender(queue_name=queue_name)
-        with sender:
-            sender.send_messages(
-                ServiceBusMessage(
-                    json.dumps(message_body),
-                    content_type="application/json",
-                    message_id=image_id,
-                )
-            )
+    # With bytes and a known length the SDK sends images up to
+    # max_single_put_size as one PUT and only splits larger ones into blocks.
+    # The message is only enqueued once the blob exists, so a failed upload
+    # never leaves a job pointing at a missing image.
+    try:
+        blob_client.upload_blob(
+            data,
+            length=len(data),
+            blob_type=BlobType.BLOCKBLOB,
+            overwrite=True,
+            metadata=blob_metadata,
+            content_settings=content_settings,
+            max_concurrency=BLOB_UPLOAD_CONCURRENCY,
+        )
+    except Exception:
+        logger.error("Raw image upload failed for %s", image_id)
+        raise
+    _send_batcher.submit(message).result(timeout=SB_SEND_TIMEOUT)
 
     return jsonify({
         "success": True,
         "image_id": image_id,
         "blob_name": blob_name,
-        "raw_container": raw_container,
-        "queue": queue_name,
+        "raw_container": RAW_CONTAINER,
+        "queue": QUEUE_NAME,
         "enqueued_at": received_at,
     }), 202
@@ -4,33 +4,64 @@ Downloads raw images, runs analysis, and writes processed JSON to Blob Storage.
 """
 
 import asyncio
+import functools
 import json
 import logging
 import os
-import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 from typing import Optional
 
-from azure.identity import DefaultAzureCredential
-from azure.servicebus import ServiceBusClient
-from azure.storage.blob import BlobServiceClient, ContentSettings
+from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
+from azure.servicebus.aio import ServiceBusClient, ServiceBusReceiver
+from azure.storage.blob import ContentSettings
+from azure.storage.blob.aio import BlobServiceClient, ContainerClient
 
 from agents.defect_analyzer_gpt52 import WikoDefectAnalyzerGPT52
+from utils.azure_clients import close_async_credential, get_async_credential
+
+# orjson when installed (see requirements.txt); stdlib json otherwise.
+# _dumps returns UTF-8 bytes either way.
+try:
+    import orjson
+
+    _dumps = orjson.dumps
+    _loads = orjson.loads
+except ImportError:
+    def _dumps(obj) -> bytes:
+        return json.dumps(obj).encode("utf-8")
+
+    _loads = json.loads
 
 logger = logging.getLogger("defect_worker")
 
-_blob_service_client: Optional[BlobServiceClient] = None
-_servicebus_client: Optional[ServiceBusClient] = None
-_event_loop: Optional[asyncio.AbstractEventLoop] = None
 
+class RawBlobNotFoundError(Exception):
+    """The raw image a message points at does not exist"""
 
-def _get_event_loop() -> asyncio.AbstractEventLoop:
-    global _event_loop
-    if _event_loop is None or _event_loop.is_closed():
-        _event_loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(_event_loop)
-    return _event_loop
 
+# Read once at import; changing these requires a restart
+RAW_CONTAINER = os.getenv("AZURE_STORAGE_RAW_CONTAINER", "raw-images")
+PROCESSED_CONTAINER = os.getenv("AZURE_STORAGE_PROCESSED_CONTAINER", "processed-images")
+QUEUE_NAME = os.getenv("AZURE_SERVICEBUS_QUEUE", "defect-jobs")
+
+_blob_service_client: Optional[BlobServiceClient] = None
+_servicebus_client: Optional[ServiceBusClient] = None
+# Blobs above max_single_get_size are fetched as ranged GETs of
+# max_chunk_get_size, BLOB_DOWNLOAD_CONCURRENCY at a time
+_BLOB_CLIENT_OPTIONS = {
+    "max_single_get_size": 4 * 1024 * 1024,
+    "max_chunk_get_size": 4 * 1024 * 1024,
+    # Storage's default backoff starts at 15s; retry after roughly 1s, 3s, 5s
+    "retry_total": 3,
+    "initial_backoff": 1,
+    "increment_base": 2,
+}
+_SERVICEBUS_CLIENT_OPTIONS = {
+    "retry_total": 3,
+    "retry_backoff_factor": 0.5,
+}
+BLOB_DOWNLOAD_CONCURRENCY = int(os.getenv("BLOB_DOWNLOAD_CONCURRENCY", "8"))
 
 def _get_blob_service_client() -> BlobServiceClient:
     global _blob_service_client
@@ -40,17 +71,27 @@ def _get_blob_service_client() -> BlobServiceClient:
     conn_string = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
     account_name = os.getenv("AZURE_STORAGE_ACCOUNT")
     if conn_string:
-        _blob_service_client = BlobServiceClient.from_connection_string(conn_string)
+        _blob_service_client = BlobServiceClient.from_connection_string(conn_string, **_BLOB_CLIENT_OPTIONS)
         return _blob_service_client
 
     if not account_name:
         raise ValueError("AZURE_STORAGE_ACCOUNT is required when no connection string is provided")
 
     account_url = f"https://{account_name}.blob.core.windows.net"
-    _blob_service_client = BlobServiceClient(account_url=account_url, credential=DefaultAzureCredential())
+    _blob_service_client = BlobServiceClient(
+        account_url=account_url,
+        credential=get_async_credential(),
+        **_BLOB_CLIENT_OPTIONS,
+    )
     return _blob_service_client
 
 
+@functools.lru_cache(maxsize=8)
+def _container_client(container_name: str) -> ContainerClient:
+    """Per-container client; blob clients made from it share its pipeline"""
+    return _get_blob_service_client().get_container_client(container_name)
+
+
 def _get_servicebus_client() -> ServiceBusClient:
     global _servicebus_client
     if _servicebus_client:
@@ -60,7 +101,7 @@ def _get_servicebus_client() -> ServiceBusClient:
     namespace = os.getenv("AZURE_SERVICEBUS_NAMESPACE")
 
     if conn_string:
-        _servicebus_client = ServiceBusClient.from_connection_string(conn_string)
+        _servicebus_client = ServiceBusClient.from_connection_string(conn_string, **_SERVICEBUS_CLIENT_OPTIONS)
         return _servicebus_client
 
     if not namespace:
@@ -71,7 +112,8 @@ def _get_servicebus_client() -> ServiceBusClient:
 
     _servicebus_client = ServiceBusClient(
         fully_qualified_namespace=namespace,
-        credential=DefaultAzureCredential(),
+        credential=get_async_credential(),
+        **_SERVICEBUS_CLIENT_OPTIONS,
     )
     return _servicebus_client
 
@@ -80,9 +122,8 @@ def _decode_message_body(message) -> dict:
     body = message.body
     if hasattr(body, "__iter__") and not isinstance(body, (bytes, str)):
         body = b"".join(body)
-    if isinstance(body, bytes):
-        body = body.decode("utf-8")
-    return json.loads(body)
+    # Both parsers accept UTF-8 bytes directly
+    return _loads(body)
 
 
 def _build_processed_payload(image_id: str, analysis, payload: dict) -> dict:
@@ -119,13 +160,10 @@ def _build_processed_payload(image_id: str, analysis, payload: dict) -> dict:
     }
 
 
-def _process_message(analyzer: WikoDefectAnalyzerGPT52, payload: dict) -> None:
+async def _process_message(analyzer: WikoDefectAnalyzerGPT52, payload: dict) -> None:
     image_id = payload.get("image_id")
-    raw_container = payload.get("raw_container", os.getenv("AZURE_STORAGE_RAW_CONTAINER", "raw-images"))
-    processed_container = payload.get(
-        "processed_container",
-        os.getenv("AZURE_STORAGE_PROCESSED_CONTAINER", "processed-images"),
-    )
+    raw_container = payload.get("raw_container", RAW_CONTAINER)
+    processed_container = payload.get("processed_container", PROCESSED_CONTAINER)
     blob_name = payload.get("blob_name")
     product_sku = payload.get("product_sku")
     facility = payload.get("facility")
@@ -133,85 +171,172 @@ def _process_message(analyzer: WikoDefectAnalyzerGPT52, payload: dict) -> None:
     if not all([image_id, blob_name, product_sku, facility]):
         raise ValueError("Missing required fields in message payload")
 
-    blob_service = _get_blob_service_client()
-
     processed_blob_name = f"{image_id}.json"
-    processed_blob_client = blob_service.get_blob_client(
-        container=processed_container,
-        blob=processed_blob_name,
-    )
-    if processed_blob_client.exists():
+    processed_blob_client = _container_client(processed_container).get_blob_client(processed_blob_name)
+    if await processed_blob_client.exists():
         logger.info("Processed blob already exists for %s, skipping", image_id)
         return
 
-    raw_blob_client = blob_service.get_blob_client(container=raw_container, blob=blob_name)
-
-    with tempfile.NamedTemporaryFile(suffix=os.path.splitext(blob_name)[1]) as tmp:
-        download_stream = raw_blob_client.download_blob()
-        download_stream.readinto(tmp)
-        tmp.flush()
-
-        loop = _get_event_loop()
-        analysis = loop.run_until_complete(
-            analyzer.analyze_defect(
-                image_path=tmp.name,
-                product_sku=product_sku,
-                facility=facility,
-                production_data=payload.get("metadata"),
-            )
-        )
+    raw_blob_client = _container_client(raw_container).get_blob_client(blob_name)
+
+    # Images are at most 16MB; keep them in memory rather than round-tripping
+    # through a temp file the analyzer would immediately read back
+    try:
+        download_stream = await raw_blob_client.download_blob(max_concurrency=BLOB_DOWNLOAD_CONCURRENCY)
+        image_bytes = await download_stream.readall()
+    except ResourceNotFoundError as exc:
+        # Only a missing blob is permanent; a missing container is left to
+        # the normal retry path so it can be fixed and the job recovered
+        if getattr(exc, "error_code", None) == "BlobNotFound":
+            raise RawBlobNotFoundError(f"{raw_container}/{blob_name}") from exc
+        raise
+
+    media_type = payload.get("content_type") or ""
+    if not media_type.startswith("image/"):
+        media_type = "image/jpeg"
+
+    analysis = await analyzer.analyze_defect_bytes(
+        image_bytes,
+        product_sku=product_sku,
+        facility=facility,
+        production_data=payload.get("metadata"),
+        media_type=media_type,
+        image_url=raw_blob_client.url,
+    )
 
     processed_payload = _build_processed_payload(image_id, analysis, payload)
-    processed_blob_client.upload_blob(
-        json.dumps(processed_payload),
-        overwrite=True,
-        content_settings=ContentSettings(content_type="application/json"),
+    # Conditional create (If-None-Match: *): if a concurrent delivery of the
+    # same message wrote the result first, keep that one and treat this as done
+    payload_bytes = _dumps(processed_payload)
+    try:
+        await processed_blob_client.upload_blob(
+            payload_bytes,
+            length=len(payload_bytes),
+            overwrite=False,
+            content_settings=ContentSettings(content_type="application/json"),
+        )
+    except ResourceExistsError:
+        logger.info("Processed blob for %s was written concurrently, skipping", image_id)
+
+
+async def _handle_message(
+    receiver: ServiceBusReceiver,
+    analyzer: WikoDefectAnalyzerGPT52,
+    message,
+    max_delivery_attempts: int,
+) -> None:
+    try:
+        payload = _decode_message_body(message)
+        await _process_message(analyzer, payload)
+        await receiver.complete_message(message)
+        logger.info("Processed message %s", payload.get("image_id"))
+    except RawBlobNotFoundError as exc:
+        # /ingest enqueues only after the raw upload succeeds, so a missing
+        # raw blob was deleted and redelivery cannot help
+        logger.exception("Failed processing message: %s", exc)
+        try:
+            await receiver.dead_letter_message(
+                message,
+                reason="blob-not-found",
+                error_description=str(exc),
+            )
+        except Exception:
+            logger.exception("Failed settling message %s", message.message_id)
+    except Exception as exc:
+        logger.exception("Failed processing message: %s", exc)
+        try:
+            if message.delivery_count >= max_delivery_attempts:
+                await receiver.dead_letter_message(
+                    message,
+                    reason="processing-failed",
+                    error_description=str(exc),
+                )
+            else:
+                await receiver.abandon_message(message)
+        except Exception:
+            # The lock will expire and Service Bus redelivers the message
+            logger.exception("Failed settling message %s", message.message_id)
+
+
+async def run() -> None:
+    max_messages = int(os.getenv("WORKER_MAX_MESSAGES", "10"))
+    max_delivery_attempts = int(os.getenv("WORKER_MAX_DELIVERY_ATTEMPTS", "5"))
+    concurrency = int(os.getenv("WORKER_CONCURRENCY", "8"))
+    batch_size = int(os.getenv("SB_BATCH", "16"))
+    # Prefetched messages are locked while they wait in the local buffer, so
+    # keep the buffer near what the worker can start on promptly
+    prefetch_count = int(os.getenv("SB_PREFETCH", str(concurrency)))
+
+    # The analyzer's model calls are blocking and run via asyncio.to_thread on
+    # the loop's default executor. Size it explicitly: the stock default is
+    # cpu_count + 4, which on a small job container caps in-flight analyses
+    # below WORKER_CONCURRENCY.
+    worker_threads = int(os.getenv("WORKER_THREADS", str(concurrency)))
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=worker_threads, thread_name_prefix="analyzer-io")
     )
 
+    analyzer = WikoDefectAnalyzerGPT52()
+    servicebus_client = _get_servicebus_client()
+    blob_service = _get_blob_service_client()
+
+    # Each message holds a slot from receipt until it is settled, so at most
+    # `concurrency` messages are locked and in flight at once
+    sem = asyncio.Semaphore(concurrency)
+    tasks = set()
+
+    async def _handle_and_release(receiver: ServiceBusReceiver, message) -> None:
+        try:
+            await _handle_message(receiver, analyzer, message, max_delivery_attempts)
+        finally:
+            sem.release()
+
+    received = 0
+    try:
+        async with servicebus_client, blob_service:
+            receiver = servicebus_client.get_queue_receiver(
+                queue_name=QUEUE_NAME,
+                max_wait_time=10,
+                prefetch_count=prefetch_count,
+            )
+            async with receiver:
+                try:
+                    while received < max_messages:
+                        # Wait for one free slot, then take any others that are
+                        # free so a single receive can pull a batch
+                        await sem.acquire()
+                        slots = 1
+                        wanted = min(batch_size, max_messages - received)
+                        while slots < wanted and not sem.locked():
+                            await sem.acquire()
+                            slots += 1
+
+                        messages = await receiver.receive_messages(max_message_count=slots, max_wait_time=10)
+                        for _ in range(slots - len(messages)):
+                            sem.release()
+                        if not messages:
+                            logger.info("No messages received, exiting")
+                            break
+
+                        received += len(messages)
+                        for message in messages:
+                            task = asyncio.create_task(_handle_and_release(receiver, message))
+                            tasks.add(task)
+                            task.add_done_callback(tasks.discard)
+                finally:
+                    # Settle everything in flight before the receiver closes
+                    if tasks:
+                        await asyncio.gather(*tasks)
+    finally:
+        await close_async_credential()
+
 
 def main() -> None:
     logging.basicConfig(
         level=os.getenv("LOG_LEVEL", "INFO"),
         format="%(asctime)s %(levelname)s %(name)s %(message)s",
     )
-
-    queue_name = os.getenv("AZURE_SERVICEBUS_QUEUE", "defect-jobs")
-    max_messages = int(os.getenv("WORKER_MAX_MESSAGES", "10"))
-    max_delivery_attempts = int(os.getenv("WORKER_MAX_DELIVERY_ATTEMPTS", "5"))
-
-    analyzer = WikoDefectAnalyzerGPT52()
-    servicebus_client = _get_servicebus_client()
-
-    processed = 0
-    with servicebus_client:
-        receiver = servicebus_client.get_queue_receiver(
-            queue_name=queue_name,
-            max_wait_time=10,
-        )
-        with receiver:
-            while processed < max_messages:
-                messages = receiver.receive_messages(max_message_count=1, max_wait_time=10)
-                if not messages:
-                    logger.info("No messages received, exiting")
-                    break
-
-                for message in messages:
-                    try:
-                        payload = _decode_message_body(message)
-                        _process_message(analyzer, payload)
-                        receiver.complete_message(message)
-                        processed += 1
-                        logger.info("Processed message %s", payload.get("image_id"))
-                    except Exception as exc:
-                        logger.exception("Failed processing message: %s", exc)
-                        if message.delivery_count >= max_delivery_attempts:
-                            receiver.dead_letter_message(
-                                message,
-                                reason="processing-failed",
-                                error_description=str(exc),
-                            )
-                        else:
-                            receiver.abandon_message(message)
+    asyncio.run(run())
 
 
 if __name__ == "__main__":